@@ -4,22 +4,81 @@ HoYoLab Code Notifier
 Fetches new redemption codes and sends Discord webhook notifications
 """
 
+import copy
+import csv
+import functools
+import io
+import gzip
+import asyncio
+import bisect
 import json
 import os
+import hashlib
+import heapq
+import hmac
+import re
+import sqlite3
+import random
+import socket
+import string
+import tempfile
+import uuid
 import time
 import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from flask import Flask, render_template, request, jsonify
 from datetime import datetime, timedelta
 from dateutil import parser as date_parser
 from dateutil.tz import tzutc
 import pytz
 
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+try:
+    import httpx
+except ImportError:  # Only needed for the asyncio pipeline engine
+    httpx = None
+
 app = Flask(__name__)
 
 # Paths
 CONFIG_PATH = os.environ.get('CONFIG_PATH', '/app/data/config.json')
+CONFIG_LOCK_PATH = f"{CONFIG_PATH}.lock"  # Serializes config updates across workers
 CODES_PATH = os.environ.get('CODES_PATH', '/app/data/sent_codes.json')
+CODES_STORAGE = os.environ.get('CODES_STORAGE', 'sqlite').lower()  # "sqlite" or "json"
+CODES_DB_PATH = os.environ.get('CODES_DB_PATH', os.path.join(os.path.dirname(CODES_PATH), 'sent_codes.db'))
+CODES_ARCHIVE_PATH = os.environ.get(
+    'CODES_ARCHIVE_PATH', os.path.join(os.path.dirname(CODES_PATH), 'sent_codes_archive.jsonl.gz')
+)
+CODES_ARCHIVE_LOCK_PATH = f"{CODES_ARCHIVE_PATH}.lock"  # Serializes archive appends and rewrites across workers
+CODES_DIGEST_PATH = re.sub(r'(\.jsonl)?(\.gz)?$', '', CODES_ARCHIVE_PATH) + '.digest.json'
+DELIVERY_QUEUE_PATH = os.environ.get(
+    'DELIVERY_QUEUE_PATH', os.path.join(os.path.dirname(CODES_PATH), 'delivery_queue.json')
+)
+DELIVERY_QUEUE_LOCK_PATH = f"{DELIVERY_QUEUE_PATH}.lock"  # Serializes delivery queue changes across workers
+REMINDER_CODES_PATH = os.path.join(os.path.dirname(CODES_PATH), 'reminder_codes.json')
+STATS_OUTBOX_PATH = os.environ.get(
+    'STATS_OUTBOX_PATH', os.path.join(os.path.dirname(CODES_PATH), 'stats_outbox.json')
+)
+STATS_OUTBOX_LIMIT = 10000  # Oldest statistics events are dropped beyond this, e.g. while the backend is down
+
+# Checker coordination: only the worker/node holding the leader lock polls and sends notifications
+RUN_CHECKER = os.environ.get('RUN_CHECKER', 'auto').lower()  # "auto" = compete for leadership, "false" = web only
+LEADER_LOCK = os.environ.get('LEADER_LOCK', 'file').lower()  # "file", "sqlite" or "none"
+LEADER_LOCK_PATH = os.environ.get('LEADER_LOCK_PATH')  # Defaults to checker.lock / checker_lease.db in the data dir
+LEADER_LEASE_TTL = 30  # Seconds a SQLite lease stays valid without renewal
+LEADER_RENEW_INTERVAL = 5  # Seconds between leadership renewals, trigger and heartbeat checks
+CHECK_TRIGGER_PATH = os.path.join(os.path.dirname(CODES_PATH), 'check_now.trigger')
+CHECKER_HEARTBEAT_PATH = os.path.join(os.path.dirname(CODES_PATH), 'checker.heartbeat')
+METRICS_SNAPSHOT_PATH = os.path.join(os.path.dirname(CODES_PATH), 'metrics.prom')
+COMPACTION_STAMP_PATH = os.path.join(os.path.dirname(CODES_PATH), 'storage_compacted.stamp')  # Touched after each compaction
 
 # Static game data (not user configurable)
 GAMES_DATA = {
@@ -40,19 +99,728 @@ GAMES_DATA = {
     }
 }
 
+# Premium currency of each game, matched in reward names by the min_currency webhook filter
+PREMIUM_CURRENCY = {
+    "genshin": "primogem",
+    "starrail": "stellar jade",
+    "zenless": "polychrome"
+}
+
+# Columns of webhook CSV import/export; template, filters and rules hold JSON
+WEBHOOK_CSV_FIELDS = ["name", "url", "games", "batch_codes", "reminders", "enabled", "template", "filters", "rules"]
+
+# Conditions a webhook filter or rule can test, see get_code_facts()
+RULE_CONDITIONS = {"reward_keywords", "min_currency", "max_currency", "expires_within_hours"}
+
+# Game-specific mascot names and avatars used as the webhook identity
+MASCOTS = {
+    "genshin": {
+        "name": "Paimon",
+        "avatar": "https://fastcdn.hoyoverse.com/static-resource-v2/2023/11/08/9db76fb146f82c045bc276956f86e047_6878380451593228482.png"
+    },
+    "starrail": {
+        "name": "PomPom",
+        "avatar": "https://fastcdn.hoyoverse.com/static-resource-v2/2025/09/24/de09aa694c26b87448cf03af683e3109_6737621355140099473.jpg"
+    },
+    "zenless": {
+        "name": "Eous",
+        "avatar": "https://hyl-static-res-prod.hoyolab.com/communityweb/business/nap.png"
+    }
+}
+
+# Embed color for each game
+GAME_COLORS = {
+    "genshin": 0x00BFFF,    # Light blue
+    "starrail": 0x9B59B6,   # Purple
+    "zenless": 0xF1C40F     # Yellow
+}
+
 # Default configuration (user settings only)
 DEFAULT_CONFIG = {
     "webhooks": [],  # List of webhook configs: [{name, url, games: {genshin: true, ...}}]
     "check_interval": 300,  # 5 minutes
     "timezone": "UTC",  # Timezone for displaying expiration times (e.g., "Europe/Paris", "America/New_York", "Asia/Tokyo")
+    "fetch_deadline": 20,  # Max seconds a check cycle waits for all games to be fetched
+    "delivery_workers": 8,  # Max webhooks posted to at the same time
+    "webhook_min_interval": 0.5,  # Min seconds between sends to a webhook whose rate limit is not known yet
+    "webhook_max_retries": 3,  # Times a send is retried after a 429 response
+    "http_timeout": 10,  # Seconds before an outbound HTTP request gives up
+    "http_pool_maxsize": 32,  # Keep-alive connections kept open per host
+    "http_retries": 2,  # Retries for connection errors (and 502/503/504 on GET requests)
+    "delivery_max_attempts": 6,  # Failed deliveries move to the dead-letter list after this many attempts
+    "delivery_retry_base": 30,  # Seconds before the first retry, doubled on every further attempt
+    "delivery_retry_max": 3600,  # Upper bound for the retry delay in seconds
+    "dead_letter_max": 500,  # Dead-lettered deliveries kept for inspection and retry; the oldest are dropped beyond this
+    "dead_letter_days": 7,  # Dead-lettered deliveries older than this are dropped
+    "stats_endpoint": "https://hoyolab-backend.satrawi.cc/api/webhook/code-discovered",  # Statistics backend for discovered codes ("" = disabled)
+    "stats_batch_size": 1,  # Events per statistics request; above 1 they are sent as a JSON array
+    "stats_flush_interval": 5,  # Seconds the statistics outbox collects events before sending them
+    "webhook_disable_after": 3,  # Webhooks are disabled after this many 404s in a row from Discord (0 = never)
+    "webhook_validation_rate": 5,  # Max webhook lookups per second when validating webhooks
+    "storage_compact_interval": 86400,  # Seconds between compactions of the sent codes store
+    "retention_days": 30,  # Codes expired longer ago than this are moved to the compressed archive
+    "max_hot_codes": 1000,  # Per game; beyond this the oldest codes without expiration are archived too
+    "pipeline_engine": "threads",  # "threads" or "asyncio" (needs httpx) for fetching and webhook fan-out
+    "adaptive_polling": True,  # Poll each game on its own schedule instead of every check_interval
+    "fast_check_interval": 60,  # Poll interval around fast windows and right after a code drop
+    "max_check_interval": 1800,  # Longest interval a quiet game backs off to
+    "burst_duration": 7200,  # Seconds after a new code during which a game is polled at fast_check_interval
+    "fast_windows": [],  # [{"games": [...], "weekday": 0-6 (Mon=0), "date": "YYYY-MM-DD", "start": "HH:MM", "end": "HH:MM"}]
+    "trigger_token": "",  # /api/trigger requires it in the X-Trigger-Token header; disabled while empty
+    "trigger_min_interval": 60,  # Min seconds between push triggers of the same game
+    "sources": [],  # Extra code sources: [{name, type: ennead|json|html, url ("{game}" placeholder), games, trusted, ...}]
+    "source_min_confirmations": 2,  # Sources that must report a code before it is sent, unless one of them is trusted
+    "expiration_reminders": [24, 1],  # Hours before a sent code expires at which webhooks get a reminder
+    "batch_window": 2,  # Seconds new codes are gathered before being sent together (up to 10 per message)
 }
 
+
+
+def parse_expiration_timestamp(expiration):
+    """Unix timestamp of a stored ISO expiration, or None if it cannot be parsed"""
+    if not expiration:
+        return None
+    try:
+        # Stored expirations are written with isoformat(), which parses much faster than dateutil
+        exp_date = datetime.fromisoformat(expiration)
+    except ValueError:
+        try:
+            exp_date = date_parser.parse(expiration)
+        except (ValueError, OverflowError):
+            return None
+    if exp_date.tzinfo is None:
+        exp_date = pytz.UTC.localize(exp_date)
+    return exp_date.timestamp()
+
+
+def code_digest(code):
+    """64-bit digest identifying an archived code, so dedup does not need the archive itself"""
+    return int.from_bytes(hashlib.blake2b(code.encode(), digest_size=8).digest(), "big")
+
+
+def get_reminder_thresholds():
+    """Configured reminder thresholds in hours, largest first"""
+    return tuple(sorted({float(hours) for hours in state.config.get("expiration_reminders", [24, 1])}, reverse=True))
+
+
+class ExpirationIndex:
+    """Min-heaps of upcoming expirations and reminder times, so due events are found without scanning all codes.
+
+    Heap entries are never removed: an entry whose code was cleared or got another
+    expiration no longer matches self.expirations and is skipped when it reaches the top.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.expirations = {}  # (game, code) -> expiration timestamp
+        self.expired = set()  # (game, code) whose expiration has passed
+        self.expiry_heap = []  # (expiration, game, code)
+        self.reminder_heap = []  # (fire_at, game, code, hours_before, expiration)
+        self.thresholds = ()  # Reminder hours the reminder heap was built with
+
+    def rebuild(self, code_expiration, thresholds):
+        """Index all stored expirations, scheduling only reminders that are still ahead"""
+        now = time.time()
+        expirations = {}
+        for game_key, codes in code_expiration.items():
+            for code, expiration in codes.items():
+                timestamp = parse_expiration_timestamp(expiration)
+                if timestamp is not None:
+                    expirations[(game_key, code)] = timestamp
+        
+        expiry_heap = [(ts, game_key, code) for (game_key, code), ts in expirations.items() if ts > now]
+        reminder_heap = [
+            (ts - hours * 3600, game_key, code, hours, ts)
+            for (game_key, code), ts in expirations.items() for hours in thresholds if ts - hours * 3600 > now
+        ]
+        heapq.heapify(expiry_heap)
+        heapq.heapify(reminder_heap)
+        
+        with self.lock:
+            self.expirations = expirations
+            self.expired = {key for key, ts in expirations.items() if ts <= now}
+            self.expiry_heap = expiry_heap
+            self.reminder_heap = reminder_heap
+            self.thresholds = tuple(thresholds)
+
+    def add(self, game_key, code, expiration):
+        """Index the expiration of a newly sent code"""
+        timestamp = parse_expiration_timestamp(expiration)
+        if timestamp is None:
+            return
+        now = time.time()
+        with self.lock:
+            self.expirations[(game_key, code)] = timestamp
+            self.expired.discard((game_key, code))
+            if timestamp <= now:
+                self.expired.add((game_key, code))
+                return
+            heapq.heappush(self.expiry_heap, (timestamp, game_key, code))
+            for hours in self.thresholds:
+                if timestamp - hours * 3600 > now:
+                    heapq.heappush(self.reminder_heap, (timestamp - hours * 3600, game_key, code, hours, timestamp))
+
+    def discard(self, game_key, codes):
+        """Forget the expirations of some codes of a game"""
+        with self.lock:
+            for code in codes:
+                self.expirations.pop((game_key, code), None)
+                self.expired.discard((game_key, code))
+
+    def remove_game(self, game_key):
+        """Forget the expirations of one game's codes"""
+        with self.lock:
+            self.expirations = {key: ts for key, ts in self.expirations.items() if key[0] != game_key}
+            self.expired = {key for key in self.expired if key[0] != game_key}
+
+    def pop_expired(self):
+        """Mark codes whose expiration has passed as expired; returns the newly expired (game, code) pairs"""
+        now = time.time()
+        newly_expired = []
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                timestamp, game_key, code = heapq.heappop(self.expiry_heap)
+                if self.expirations.get((game_key, code)) == timestamp:
+                    self.expired.add((game_key, code))
+                    newly_expired.append((game_key, code))
+        return newly_expired
+
+    def pop_reminders(self):
+        """Due reminders as (game, code, hours_before, expiration) tuples"""
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.reminder_heap and self.reminder_heap[0][0] <= now:
+                _, game_key, code, hours, timestamp = heapq.heappop(self.reminder_heap)
+                if self.expirations.get((game_key, code)) == timestamp and timestamp > now:
+                    due.append((game_key, code, hours, timestamp))
+        return due
+
+    def next_reminder_time(self):
+        """Time the next reminder falls due, or None"""
+        with self.lock:
+            return self.reminder_heap[0][0] if self.reminder_heap else None
+
+    def is_expired(self, game_key, code):
+        """Whether a code's expiration has passed, as of the last pop_expired()"""
+        return (game_key, code) in self.expired
+
+
+def get_currency_amount(game_key, rewards):
+    """Amount of the game's premium currency in a code's rewards"""
+    currency = PREMIUM_CURRENCY.get(game_key)
+    amount = 0
+    for reward in rewards or []:
+        if isinstance(reward, dict):
+            if currency and currency in str(reward.get("name", "")).lower():
+                try:
+                    amount += int(reward.get("count", 1))
+                except (TypeError, ValueError):
+                    pass
+        elif currency and currency in str(reward).lower():
+            # "Primogem x60", "60 Primogems"
+            match = re.search(r"(\d[\d,]*)", str(reward))
+            if match:
+                amount += int(match.group(1).replace(",", ""))
+    return amount
+
+
+def get_code_facts(game_key, code_data, now=None):
+    """Values webhook filters and rules are evaluated against, computed once per code, as of now"""
+    rewards = code_data.get("rewards", [])
+    expiration_date = parse_expiration_date(code_data)
+    if expiration_date is not None and expiration_date.tzinfo is None:
+        expiration_date = pytz.UTC.localize(expiration_date)
+    return {
+        "reward_text": format_rewards(rewards).lower(),
+        "currency": get_currency_amount(game_key, rewards),
+        "expires_in": (expiration_date.timestamp() - (now or time.time())) / 3600 if expiration_date else None
+    }
+
+
+def normalize_conditions(conditions):
+    """Validated conditions of a filter or rule with the inactive ones left out, or raise ValueError"""
+    normalized = {}
+    keywords = conditions.get("reward_keywords")
+    if keywords is not None:
+        if not isinstance(keywords, list) or not all(isinstance(keyword, str) for keyword in keywords):
+            raise ValueError("reward_keywords must be a list of strings")
+        keywords = tuple(dict.fromkeys(keyword.lower() for keyword in keywords if keyword))
+        if keywords:
+            normalized["reward_keywords"] = keywords
+    for name in ("min_currency", "max_currency", "expires_within_hours"):
+        value = conditions.get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f"{name} must be a positive number")
+        if name != "min_currency" or value > 0:
+            normalized[name] = value
+    return normalized
+
+
+def compile_conditions(conditions):
+    """Predicate over code facts that is true when every normalized condition holds"""
+    checks = []
+    if "reward_keywords" in conditions:
+        keywords = conditions["reward_keywords"]
+        checks.append(lambda facts: any(keyword in facts["reward_text"] for keyword in keywords))
+    if "min_currency" in conditions:
+        minimum = conditions["min_currency"]
+        checks.append(lambda facts: facts["currency"] >= minimum)
+    if "max_currency" in conditions:
+        maximum = conditions["max_currency"]
+        checks.append(lambda facts: facts["currency"] <= maximum)
+    if "expires_within_hours" in conditions:
+        hours = conditions["expires_within_hours"]
+        checks.append(lambda facts: facts["expires_in"] is not None and facts["expires_in"] <= hours)
+    if len(checks) == 1:
+        return checks[0]
+    return lambda facts: all(check(facts) for check in checks)
+
+
+def compile_filters(filters):
+    """Normalized filters of a webhook and their predicate, or raise ValueError"""
+    if filters is None:
+        return {}, None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    unknown = set(filters) - RULE_CONDITIONS
+    if unknown:
+        raise ValueError(f"Unknown filter(s): {', '.join(sorted(unknown))}")
+    normalized = normalize_conditions(filters)
+    return normalized, compile_conditions(normalized) if normalized else None
+
+
+def compile_rules(rules):
+    """Ordered (predicate, action, mention) rules of a webhook, or raise ValueError"""
+    if rules is None:
+        return ()
+    if not isinstance(rules, list):
+        raise ValueError("rules must be a list")
+    compiled = []
+    for rule in rules:
+        if not isinstance(rule, dict):
+            raise ValueError("Each rule must be an object")
+        unknown = set(rule) - RULE_CONDITIONS - {"action", "mention"}
+        if unknown:
+            raise ValueError(f"Unknown rule field(s): {', '.join(sorted(unknown))}")
+        action = rule.get("action", "send")
+        if action not in ("send", "skip"):
+            raise ValueError("Rule action must be 'send' or 'skip'")
+        mention = rule.get("mention") or ""
+        if not isinstance(mention, str):
+            raise ValueError("Rule mention must be a string")
+        conditions = normalize_conditions(rule)
+        compiled.append((compile_conditions(conditions) if conditions else None, action, mention))
+    return tuple(compiled)
+
+
+def validate_webhook_rules(webhook):
+    """Raise ValueError if a webhook's filters or rules cannot be compiled"""
+    compile_filters(webhook.get("filters"))
+    compile_rules(webhook.get("rules"))
+
+
+class WebhookRoutes:
+    """Routing index over the configured webhooks: URL -> webhook, and game -> destinations grouped by filter.
+
+    Published alongside the config and never changed afterwards; updated() returns a new index in
+    which only webhooks that were added, changed or removed are re-indexed and have their filters
+    and rules compiled. A webhook without filters always matches, one filtering only on keywords
+    is found through the keyword map, one with only a minimum currency amount through a sorted
+    threshold list, and only the others have their compiled filter evaluated one by one. A webhook
+    whose filters or rules do not compile is not routed at all, rather than sent every code.
+    """
+
+    def __init__(self):
+        self.by_url = {}  # url -> webhook dict
+        self.order = {}  # url -> position in the config, so deliveries keep the config order
+        self.compiled = {}  # url -> (normalized filters, filter predicate, compiled rules)
+        self.games = {}  # game -> routes, see new_game_routes()
+        self.errors = {}  # url -> why the webhook's filters or rules did not compile; such webhooks get nothing
+
+    @staticmethod
+    def new_game_routes():
+        return {"all": set(), "plain": set(), "keywords": {}, "thresholds": [], "threshold_urls": [], "combined": set()}
+
+    def copy(self):
+        routes = WebhookRoutes()
+        routes.by_url = dict(self.by_url)
+        routes.compiled = dict(self.compiled)
+        routes.errors = dict(self.errors)
+        routes.games = {
+            game_key: {
+                "all": set(game["all"]),
+                "plain": set(game["plain"]),
+                "keywords": {keyword: set(urls) for keyword, urls in game["keywords"].items()},
+                "thresholds": list(game["thresholds"]),
+                "threshold_urls": list(game["threshold_urls"]),
+                "combined": set(game["combined"])
+            }
+            for game_key, game in self.games.items()
+        }
+        return routes
+
+    def add(self, webhook):
+        url = webhook["url"]
+        try:
+            filters, predicate = compile_filters(webhook.get("filters"))
+            rules = compile_rules(webhook.get("rules"))
+        except ValueError as e:
+            print(f"Not routing any code to webhook {webhook.get('name', '')}, its filters or rules are invalid: {e}")
+            self.by_url[url] = webhook
+            self.compiled[url] = ({}, None, ())
+            self.errors[url] = f"Invalid filters or rules: {e}"
+            return
+        self.by_url[url] = webhook
+        self.compiled[url] = (filters, predicate, rules)
+        if not webhook.get("enabled", True):
+            return
+        for game_key, enabled in (webhook.get("games") or {}).items():
+            if not enabled:
+                continue
+            game = self.games.setdefault(game_key, self.new_game_routes())
+            game["all"].add(url)
+            if not filters:
+                game["plain"].add(url)
+            elif set(filters) == {"reward_keywords"}:
+                for keyword in filters["reward_keywords"]:
+                    game["keywords"].setdefault(keyword, set()).add(url)
+            elif set(filters) == {"min_currency"}:
+                position = bisect.bisect_right(game["thresholds"], filters["min_currency"])
+                game["thresholds"].insert(position, filters["min_currency"])
+                game["threshold_urls"].insert(position, url)
+            else:
+                game["combined"].add(url)
+
+    def remove(self, url):
+        webhook = self.by_url.pop(url)
+        filters = self.compiled.pop(url)[0]
+        if self.errors.pop(url, None) is not None or not webhook.get("enabled", True):
+            return
+        for game_key, enabled in (webhook.get("games") or {}).items():
+            game = self.games.get(game_key)
+            if not enabled or game is None:
+                continue
+            game["all"].discard(url)
+            game["plain"].discard(url)
+            game["combined"].discard(url)
+            for keyword in filters.get("reward_keywords", ()):
+                game["keywords"].get(keyword, set()).discard(url)
+            if url in game["threshold_urls"]:
+                position = game["threshold_urls"].index(url)
+                del game["thresholds"][position]
+                del game["threshold_urls"][position]
+
+    def updated(self, webhooks):
+        """New index for a new webhook list, re-indexing only what changed"""
+        routes = self.copy()
+        seen = set()
+        for position, webhook in enumerate(webhooks):
+            if not isinstance(webhook, dict) or not webhook.get("url"):
+                continue
+            url = webhook["url"]
+            seen.add(url)
+            routes.order[url] = position
+            if routes.by_url.get(url) != webhook:
+                if url in routes.by_url:
+                    routes.remove(url)
+                routes.add(webhook)
+        for url in set(routes.by_url) - seen:
+            routes.remove(url)
+        return routes
+
+    def urls_for_game(self, game_key):
+        """All enabled webhook URLs with the game enabled, whatever their filters, in config order"""
+        return sorted(self.games.get(game_key, {}).get("all", ()), key=self.order.get)
+
+    def match(self, game_key, code_data, now=None):
+        """Webhook URLs that should receive a code, mapped to the mention their rules add to it"""
+        game = self.games.get(game_key)
+        if not game:
+            return {}
+        
+        facts = get_code_facts(game_key, code_data, now)
+        candidates = set(game["plain"])
+        for keyword, urls in game["keywords"].items():
+            if keyword in facts["reward_text"]:
+                candidates.update(urls)
+        candidates.update(game["threshold_urls"][:bisect.bisect_right(game["thresholds"], facts["currency"])])
+        candidates.update(url for url in game["combined"] if self.compiled[url][1](facts))
+        
+        # The first rule whose conditions hold decides; a code no rule matches is sent without mention
+        matched = {}
+        for url in candidates:
+            mention = ""
+            for predicate, action, rule_mention in self.compiled[url][2]:
+                if predicate is None or predicate(facts):
+                    mention = None if action == "skip" else rule_mention
+                    break
+            if mention is not None:
+                matched[url] = mention
+        return matched
+
+
+class NotifierState:
+    """Config, sent codes and expirations shared by the checker, check-now and request threads.
+
+    All changes happen under one lock. The config dict is copy-on-write: once published it
+    is never mutated, so readers can use state.config without locking and always see one
+    complete version. Sent codes are only changed under the lock; readers that need a
+    consistent view across games take codes_snapshot().
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.config = {}
+        self.routes = WebhookRoutes()  # Routing index of config["webhooks"], published with the config
+        self.sent_codes = {}  # game -> codes in the order they were sent
+        self.code_expiration = {}  # game -> {code: ISO expiration}
+        self.sent_code_index = {}  # game -> set of sent codes, for O(1) lookups
+        self.expiration_index = ExpirationIndex()  # Upcoming expirations and reminders of sent codes
+        self.archive_digest = {}  # game -> set of code_digest() of archived codes, still used for dedup
+        self.version = 0  # Bumped whenever something shown by /api/status changes
+        self.config_stamp = None  # file_stamp() of config.json as last read or written by this process
+
+    def update_config(self, mutate):
+        """Apply mutate() to a private copy of the config, then publish and save it.
+
+        If mutate raises, nothing is published. Returns what mutate returned.
+        """
+        with self.lock, config_file_lock():
+            # Another worker may have saved the config since this process last read it:
+            # apply the change on top of that version, not over it
+            reload_config_if_changed()
+            new_config = copy.deepcopy(self.config)
+            result = mutate(new_config)
+            self.routes = self.routes.updated(new_config.get("webhooks", []))
+            self.config = new_config
+            save_config()
+            return result
+
+    def load_codes(self, codes, expiration):
+        """Replace all sent codes and expirations"""
+        with self.lock:
+            self.sent_codes = codes
+            self.code_expiration = expiration
+            self.sent_code_index = {game_key: set(game_codes) for game_key, game_codes in codes.items()}
+            self.expiration_index.rebuild(expiration, get_reminder_thresholds())
+            self.version += 1
+
+    def is_code_sent(self, game_key, code):
+        """Check whether a code was already sent for a game, including archived codes"""
+        if code in self.sent_code_index.get(game_key, ()):
+            return True
+        archived = self.archive_digest.get(game_key)
+        return bool(archived) and code_digest(code) in archived
+
+    def archive_codes(self, game_key, codes):
+        """Move codes from the hot set to the archive digest"""
+        with self.lock:
+            codes = set(codes)
+            self.sent_codes[game_key] = [code for code in self.sent_codes.get(game_key, []) if code not in codes]
+            self.sent_code_index[game_key] = set(self.sent_codes[game_key])
+            game_exp = self.code_expiration.get(game_key, {})
+            for code in codes:
+                game_exp.pop(code, None)
+            self.archive_digest.setdefault(game_key, set()).update(code_digest(code) for code in codes)
+            self.expiration_index.discard(game_key, codes)
+            self.version += 1
+
+    def mark_code_sent(self, game_key, code, expiration=None):
+        """Record a code as sent, keeping the list and the lookup index in sync"""
+        with self.lock:
+            if expiration:
+                self.code_expiration.setdefault(game_key, {})[code] = expiration
+                self.expiration_index.add(game_key, code, expiration)
+            if not self.is_code_sent(game_key, code):
+                self.sent_codes.setdefault(game_key, []).append(code)
+                self.sent_code_index.setdefault(game_key, set()).add(code)
+            self.version += 1
+
+    def clear_codes(self, game_key=None):
+        """Forget sent codes for one game, or for all games"""
+        with self.lock:
+            if game_key:
+                self.sent_codes[game_key] = []
+                self.code_expiration[game_key] = {}
+                self.sent_code_index[game_key] = set()
+                self.expiration_index.remove_game(game_key)
+            else:
+                self.load_codes(*empty_sent_codes())
+            self.version += 1
+
+    def reindex_expirations_if_needed(self):
+        """Rebuild the expiration index if the configured reminder thresholds changed"""
+        with self.lock:
+            thresholds = get_reminder_thresholds()
+            if thresholds != self.expiration_index.thresholds:
+                self.expiration_index.rebuild(self.code_expiration, thresholds)
+
+    def codes_snapshot(self):
+        """Consistent copy of sent codes and expirations"""
+        with self.lock:
+            return ({game_key: list(codes) for game_key, codes in self.sent_codes.items()},
+                    {game_key: dict(exp) for game_key, exp in self.code_expiration.items()})
+
+
+class MetricsRegistry:
+    """Minimal Prometheus registry: labelled counters, gauges and histograms rendered in the text format"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}  # name -> {"type", "help", "buckets", "values": {label tuple: value or histogram}}
+        self.collectors = {}  # gauge name -> function returning {label tuple: value}, evaluated at render time
+
+    def define(self, metric_type, name, help_text, buckets=None, collect=None):
+        self.metrics[name] = {"type": metric_type, "help": help_text, "buckets": buckets, "values": {}}
+        if collect:
+            self.collectors[name] = collect
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.metrics[name]["values"]
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.metrics[name]["values"][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        metric = self.metrics[name]
+        with self.lock:
+            histogram = metric["values"].get(key)
+            if histogram is None:
+                histogram = metric["values"][key] = {"buckets": [0] * len(metric["buckets"]), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(metric["buckets"]):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        collected = {}
+        for name, collect in self.collectors.items():
+            try:
+                collected[name] = collect()
+            except Exception as e:
+                print(f"Error collecting metric {name}: {e}")
+        
+        lines = []
+        with self.lock:
+            for name, metric in self.metrics.items():
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['type']}")
+                values = collected[name] if name in collected else metric["values"]
+                for key, value in values.items():
+                    if metric["type"] != "histogram":
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                        continue
+                    for bound, count in zip(metric["buckets"], value["buckets"]):
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{name}_sum{format_labels(key)} {value['sum']}")
+                    lines.append(f"{name}_count{format_labels(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(key):
+    """Prometheus label set for a sorted label tuple"""
+    if not key:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+
+def timed(metric_name):
+    """Decorator recording a function's duration in a histogram"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe(metric_name, time.monotonic() - start)
+        return wrapper
+    return decorator
+
+
+metrics = MetricsRegistry()
+metrics.define("histogram", "hoyolab_check_duration_seconds", "Duration of a check cycle",
+               MetricsRegistry.DEFAULT_BUCKETS)
+metrics.define("histogram", "hoyolab_fetch_duration_seconds", "Code fetch latency per game and source",
+               MetricsRegistry.DEFAULT_BUCKETS)
+metrics.define("counter", "hoyolab_upstream_responses_total", "Upstream responses by source and HTTP status")
+metrics.define("counter", "hoyolab_fetch_bytes_total", "Bytes downloaded from code sources")
+metrics.define("histogram", "hoyolab_fetch_new_codes", "Codes per fetched payload that were not sent before",
+               (0, 1, 2, 5, 10, 20, 50))
+metrics.define("histogram", "hoyolab_notification_duration_seconds", "Duration of sending one batch of new codes",
+               MetricsRegistry.DEFAULT_BUCKETS)
+metrics.define("histogram", "hoyolab_webhook_delivery_duration_seconds", "Webhook delivery latency per destination",
+               MetricsRegistry.DEFAULT_BUCKETS)
+metrics.define("counter", "hoyolab_webhook_deliveries_total", "Webhook deliveries per destination and result")
+metrics.define("counter", "hoyolab_webhook_rate_limited_total", "429 responses per destination")
+metrics.define("histogram", "hoyolab_code_delivery_latency_seconds", "Time from a code being first seen to its first delivery",
+               MetricsRegistry.DEFAULT_BUCKETS)
+metrics.define("histogram", "hoyolab_save_sent_codes_duration_seconds", "Duration of storing a sent code",
+               (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+metrics.define("gauge", "hoyolab_delivery_queue_depth", "Deliveries waiting for a retry, and dead-lettered ones",
+               collect=lambda: {
+                   (("queue", "pending"),): len(delivery_queue["pending"]),
+                   (("queue", "dead_letter"),): len(delivery_queue["dead_letter"])
+               })
+metrics.define("gauge", "hoyolab_sent_codes", "Sent codes kept in the active history per game",
+               collect=lambda: {(("game", game_key),): len(codes) for game_key, codes in state.sent_codes.items()})
+
+
 # Global state
-config = {}
-sent_codes = {}
-code_expiration_data = {}  # Store expiration dates for codes
+state = NotifierState()
+code_store = None  # Storage backend for sent codes, see create_code_store()
+last_check_time = None  # ISO time the last check started
+status_cache = {"key": None, "body": None, "etag": None}  # Last serialized /api/status response
+code_views = {}  # (game, code) -> parsed and formatted expiration, reused across /api/status calls
+last_compaction = 0  # Time of the last compaction attempt in this process; the last success is COMPACTION_STAMP_PATH's mtime
+archive_digest_stamp = None  # file_stamp() of the digest file as last read or written by this process
 checker_thread = None
 stop_checker = threading.Event()
+wake_checker = threading.Event()  # Set to interrupt the checker's wait, for a stop or an early check
+leader_lock = None  # See create_leader_lock()
+check_lock = threading.Lock()  # Held while a check runs, so concurrent triggers share one check
+game_schedule = {}  # game -> {"next_poll", "quiet_interval", "last_new_code"} for adaptive polling
+check_requests = set()  # Games whose check was requested (check-now, push triggers), polled on the next wake-up
+check_requests_lock = threading.Lock()
+last_triggers = {}  # Game -> time of the last accepted push trigger in this process
+http_session = None
+http_session_lock = threading.Lock()
+async_pipeline = None  # See get_async_pipeline()
+async_pipeline_lock = threading.Lock()
+fetch_validators = {}  # Per (game, source): ETag, Last-Modified and content hash of the last fetched payload
+source_stats = {}  # Per source name: fetch count, failures, latency and how often it reported a code first
+source_stats_lock = threading.Lock()
+timezone_cache = {}  # Timezone name -> tzinfo, so notifications do not look it up per code
+compiled_templates = {}  # Template JSON -> validated template merged over DEFAULT_TEMPLATE
+message_identities = {}  # (template JSON, game) -> webhook username, avatar and content, the same for every code
+code_first_seen = {}  # (game, code) -> monotonic time a source first reported it, until it is delivered
+code_sightings = {}  # (game, code) -> names of untrusted sources that reported it, until it is confirmed
+# Outbound webhook deliveries, persisted to DELIVERY_QUEUE_PATH. Entries reference their message by
+# payload_id, so a message sent to many webhooks is stored (and serialized) once
+delivery_queue = {"pending": [], "dead_letter": [], "payloads": {}}
+delivery_queue_lock = threading.RLock()
+delivery_queue_stamp = None  # file_stamp() of the queue file as last read or written by this process
+deliveries_in_flight = set()  # IDs of queued deliveries currently being sent
+reminder_codes = {}  # game -> code -> rewards, expiration, send time and filtered flag of sent codes that expire, for routing reminders
+stats_outbox = []  # Statistics events not yet accepted by the backend, persisted to STATS_OUTBOX_PATH
+stats_outbox_lock = threading.RLock()
+stats_wake = threading.Event()  # Set when events are added to the outbox
+stats_thread = None
+file_locks_held = threading.local()  # Cross-worker file locks the current thread holds, so they can be nested
 
 
 def ensure_data_dir():
@@ -64,128 +832,960 @@ def ensure_data_dir():
 
 def load_config():
     """Load configuration from file"""
-    global config
     ensure_data_dir()
+    needs_save = False
     
     if os.path.exists(CONFIG_PATH):
         try:
             with open(CONFIG_PATH, 'r') as f:
-                config = json.load(f)
+                loaded = json.load(f)
                 # Merge with defaults for any missing keys
                 for key, value in DEFAULT_CONFIG.items():
-                    if key not in config:
-                        config[key] = value
+                    if key not in loaded:
+                        loaded[key] = copy.deepcopy(value)
                 
                 # Migrate old config format to new format
-                if "webhook_url" in config and config["webhook_url"]:
+                if "webhook_url" in loaded and loaded["webhook_url"]:
                     # Old format had single webhook_url, migrate it
-                    old_url = config["webhook_url"]
-                    old_games = config.get("games", {"genshin": True, "starrail": True, "zenless": True})
-                    if not config.get("webhooks") or not isinstance(config["webhooks"], list):
-                        config["webhooks"] = [{
+                    old_url = loaded["webhook_url"]
+                    old_games = loaded.get("games", {"genshin": True, "starrail": True, "zenless": True})
+                    if not loaded.get("webhooks") or not isinstance(loaded["webhooks"], list):
+                        loaded["webhooks"] = [{
                             "name": "Main Webhook",
                             "url": old_url,
                             "games": old_games
                         }]
-                    del config["webhook_url"]
-                    if "games" in config:
-                        del config["games"]
-                    save_config()
+                    del loaded["webhook_url"]
+                    if "games" in loaded:
+                        del loaded["games"]
+                    needs_save = True
                 
                 # Ensure webhooks is a list
-                if not isinstance(config.get("webhooks"), list):
-                    config["webhooks"] = []
+                if not isinstance(loaded.get("webhooks"), list):
+                    loaded["webhooks"] = []
                     
         except Exception as e:
             print(f"Error loading config: {e}")
-            config = DEFAULT_CONFIG.copy()
+            loaded = copy.deepcopy(DEFAULT_CONFIG)
     else:
-        config = DEFAULT_CONFIG.copy()
-        save_config()
-    
-    return config
+        loaded = copy.deepcopy(DEFAULT_CONFIG)
+        needs_save = True
+    
+    with state.lock:
+        state.routes = state.routes.updated(loaded.get("webhooks", []))
+        state.config = loaded
+        state.config_stamp = file_stamp(CONFIG_PATH)
+        if needs_save:
+            # Workers starting together all find no config file: their saves must not interleave
+            with config_file_lock():
+                save_config()
+    
+    return loaded
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock on a lock file, held across workers. Reentrant within a thread"""
+    held = file_locks_held.__dict__.setdefault("paths", set())
+    if fcntl is None or path in held:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        held.add(path)
+        yield
+    finally:
+        held.discard(path)
+        os.close(fd)
+
+
+def config_file_lock():
+    """Exclusive lock held across workers while the config is read, changed and saved.
+
+    Reentrant, since a reload under the lock can save a migrated config.
+    """
+    return file_lock(CONFIG_LOCK_PATH)
 
 
 def save_config():
     """Save configuration to file"""
     ensure_data_dir()
-    with open(CONFIG_PATH, 'w') as f:
-        json.dump(config, f, indent=2)
+    with state.lock:
+        write_json_atomic(CONFIG_PATH, state.config)
+        state.config_stamp = file_stamp(CONFIG_PATH)
+
+
+def reload_config_if_changed():
+    """Pick up config changes written by another worker or by hand"""
+    if file_stamp(CONFIG_PATH) != state.config_stamp:
+        old_timezone = state.config.get("timezone")
+        load_config()
+        if state.config.get("timezone") != old_timezone:
+            invalidate_status_cache(timezone_changed=True)
+
+
+def empty_sent_codes():
+    """Empty sent codes and expiration maps with an entry per game"""
+    return {game_key: [] for game_key in GAMES_DATA}, {game_key: {} for game_key in GAMES_DATA}
+
+
+def read_codes_file(path):
+    """Read a sent codes JSON file in either the old or the current format"""
+    codes, expiration = empty_sent_codes()
+    with open(path, 'r') as f:
+        data = json.load(f)
+    
+    # Support both old format (just codes) and new format (with expiration)
+    if isinstance(data, dict):
+        if "codes" in data and "expiration" in data:
+            codes.update(data["codes"])
+            expiration.update(data["expiration"])
+        else:
+            # Old format - just game: [codes] structure
+            codes.update(data)
+    return codes, expiration
+
+
+class JsonCodeStore:
+    """Sent codes kept in a single JSON document, rewritten atomically on every change"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.codes, self.expiration = empty_sent_codes()
+        self.stamp = None
+
+    def load(self):
+        """Read all sent codes and expirations"""
+        with self.lock:
+            if os.path.exists(self.path):
+                self.stamp = file_stamp(self.path)
+                self.codes, self.expiration = read_codes_file(self.path)
+            else:
+                self.codes, self.expiration = empty_sent_codes()
+                self.write()
+            return ({game: list(codes) for game, codes in self.codes.items()},
+                    {game: dict(exp) for game, exp in self.expiration.items()})
+
+    def write(self):
+        write_json_atomic(self.path, {"codes": self.codes, "expiration": self.expiration})
+        self.stamp = file_stamp(self.path)
+
+    def has_changed(self):
+        """Whether the file was modified by someone else since we last read or wrote it"""
+        return file_stamp(self.path) != self.stamp
+
+    def add_code(self, game_key, code, expiration=None):
+        """Store a sent code with its optional ISO expiration"""
+        with self.lock:
+            game_codes = self.codes.setdefault(game_key, [])
+            if code not in game_codes:
+                game_codes.append(code)
+            if expiration:
+                self.expiration.setdefault(game_key, {})[code] = expiration
+            self.write()
+
+    def clear(self, game_key=None):
+        """Forget sent codes for one game, or for all games"""
+        with self.lock:
+            if game_key:
+                self.codes[game_key] = []
+                self.expiration[game_key] = {}
+            else:
+                self.codes, self.expiration = empty_sent_codes()
+            self.write()
+
+    def remove_codes(self, game_key, codes):
+        """Remove archived codes from the hot file"""
+        with self.lock:
+            codes = set(codes)
+            self.codes[game_key] = [code for code in self.codes.get(game_key, []) if code not in codes]
+            game_exp = self.expiration.get(game_key, {})
+            for code in codes:
+                game_exp.pop(code, None)
+            self.write()
+
+    def compact(self):
+        """Nothing to compact, the whole file is rewritten on every change"""
+
+
+def file_stamp(path):
+    """Modification time and size of a file, or None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class SqliteCodeStore:
+    """Sent codes in SQLite (WAL mode), one row per code so storing a code is a single insert"""
+
+    def __init__(self, path, legacy_json_path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data_version = None
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sent_codes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                game TEXT NOT NULL,
+                code TEXT NOT NULL,
+                expiration TEXT,
+                sent_at REAL NOT NULL,
+                UNIQUE (game, code)
+            )
+        """)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if legacy_json_path:
+            self.migrate_json(legacy_json_path)
+
+    def migrate_json(self, json_path):
+        """One-time import of an existing sent_codes.json into the database"""
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                return
+            
+            rows = []
+            if os.path.exists(json_path):
+                try:
+                    codes, expiration = read_codes_file(json_path)
+                except Exception as e:
+                    print(f"Error reading {json_path} for migration: {e}")
+                    return
+                now = time.time()
+                for game_key, game_codes in codes.items():
+                    game_exp = expiration.get(game_key, {})
+                    rows.extend((game_key, code, game_exp.get(code), now) for code in game_codes)
+            
+            with self.conn:
+                # Another worker starting at the same time may have migrated while the file was read
+                self.conn.execute("BEGIN IMMEDIATE")
+                if self.conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                    return
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO sent_codes (game, code, expiration, sent_at) VALUES (?, ?, ?, ?)", rows
+                )
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (json_path,))
+            if rows:
+                print(f"Migrated {len(rows)} sent codes from {json_path} to {self.path}")
+
+    def load(self):
+        """Read all sent codes and expirations, in the order they were sent"""
+        codes, expiration = empty_sent_codes()
+        with self.lock:
+            self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            rows = self.conn.execute("SELECT game, code, expiration FROM sent_codes ORDER BY id").fetchall()
+        for game_key, code, exp in rows:
+            codes.setdefault(game_key, []).append(code)
+            if exp:
+                expiration.setdefault(game_key, {})[code] = exp
+        return codes, expiration
+
+    def has_changed(self):
+        """Whether another connection (process or manual edit) committed changes since we last loaded"""
+        with self.lock:
+            return self.conn.execute("PRAGMA data_version").fetchone()[0] != self.data_version
+
+    def add_code(self, game_key, code, expiration=None):
+        """Store a sent code with its optional ISO expiration"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO sent_codes (game, code, expiration, sent_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (game, code) DO UPDATE SET expiration = COALESCE(excluded.expiration, expiration)",
+                (game_key, code, expiration, time.time())
+            )
+
+    def clear(self, game_key=None):
+        """Forget sent codes for one game, or for all games"""
+        with self.lock:
+            if game_key:
+                self.conn.execute("DELETE FROM sent_codes WHERE game = ?", (game_key,))
+            else:
+                self.conn.execute("DELETE FROM sent_codes")
+
+    def remove_codes(self, game_key, codes):
+        """Remove archived codes from the hot table"""
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "DELETE FROM sent_codes WHERE game = ? AND code = ?", [(game_key, code) for code in codes]
+                )
+
+    def compact(self):
+        """Fold the write-ahead log back into the database file and refresh query statistics"""
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.conn.execute("PRAGMA optimize")
+
+
+def create_code_store():
+    """Create the sent codes storage backend selected by CODES_STORAGE"""
+    ensure_data_dir()
+    if CODES_STORAGE == "json":
+        return JsonCodeStore(CODES_PATH)
+    return SqliteCodeStore(CODES_DB_PATH, legacy_json_path=CODES_PATH)
 
 
 def load_sent_codes():
-    """Load sent codes from file"""
-    global sent_codes, code_expiration_data
+    """Load sent codes from storage"""
+    with state.lock:
+        try:
+            codes, expiration = code_store.load()
+        except Exception as e:
+            print(f"Error loading sent codes: {e}")
+            codes, expiration = empty_sent_codes()
+        state.load_codes(codes, expiration)
+        load_archive_digest()
+    return state.sent_codes
+
+
+def load_archive_digest():
+    """Load the digests of archived codes if the digest file changed since the last load"""
+    global archive_digest_stamp
+    
+    stamp = file_stamp(CODES_DIGEST_PATH)
+    if stamp == archive_digest_stamp:
+        return
+    try:
+        with open(CODES_DIGEST_PATH, 'r') as f:
+            data = json.load(f)
+        digest = {game_key: set(values) for game_key, values in data.items()}
+    except FileNotFoundError:
+        digest = {}
+    except Exception as e:
+        print(f"Error loading archived code digests: {e}")
+        return
+    with state.lock:
+        state.archive_digest = digest
+        archive_digest_stamp = stamp
+
+
+def save_archive_digest():
+    """Persist the archived code digests"""
+    global archive_digest_stamp
+    
+    with state.lock:
+        data = {game_key: sorted(values) for game_key, values in state.archive_digest.items()}
+    write_json_atomic(CODES_DIGEST_PATH, data, indent=None)
+    archive_digest_stamp = file_stamp(CODES_DIGEST_PATH)
+
+
+def select_codes_to_archive():
+    """Per game, the sent codes that fall outside the retention policy"""
+    now = time.time()
+    cutoff = now - state.config.get("retention_days", 30) * 86400
+    max_hot = state.config.get("max_hot_codes", 1000)
+    sent_codes, code_expiration = state.codes_snapshot()
+    
+    selected = {}
+    for game_key, codes in sent_codes.items():
+        game_exp = code_expiration.get(game_key, {})
+        timestamps = {code: parse_expiration_timestamp(game_exp.get(code)) for code in codes}
+        archive = [code for code in codes if timestamps[code] is not None and timestamps[code] < cutoff]
+        
+        # Bound the hot set: codes are in the order they were sent, so the oldest go first,
+        # but codes that are still active stay
+        excess = len(codes) - len(archive) - max_hot
+        if excess > 0:
+            archived = set(archive)
+            for code in codes:
+                if excess <= 0:
+                    break
+                if code not in archived and (timestamps[code] is None or timestamps[code] < now):
+                    archive.append(code)
+                    excess -= 1
+        if archive:
+            selected[game_key] = archive
+    return selected
+
+
+def archive_old_codes():
+    """Move codes outside the retention policy to the compressed archive, keeping their digests for dedup"""
+    selected = select_codes_to_archive()
+    if not selected:
+        return 0
+    
+    _, code_expiration = state.codes_snapshot()
+    archived_at = datetime.now().isoformat()
+    ensure_data_dir()
+    # Same lock order as clear_archive(), which another worker may run meanwhile
+    with state.lock, file_lock(CODES_ARCHIVE_LOCK_PATH):
+        # Appending starts a new gzip member; readers see the concatenation as one stream
+        with gzip.open(CODES_ARCHIVE_PATH, 'at', encoding='utf-8') as f:
+            for game_key, codes in selected.items():
+                for code in codes:
+                    f.write(json.dumps({
+                        "game": game_key,
+                        "code": code,
+                        "expiration": code_expiration.get(game_key, {}).get(code),
+                        "archived_at": archived_at
+                    }) + "\n")
+        
+        # Archive and digest are written before the hot copies are removed: a crash in between
+        # leaves a code in both places, which is harmless for dedup. Digests cleared by another
+        # worker are loaded first, so saving them does not bring them back
+        load_archive_digest()
+        for game_key, codes in selected.items():
+            state.archive_codes(game_key, codes)
+        save_archive_digest()
+        for game_key, codes in selected.items():
+            code_store.remove_codes(game_key, codes)
+    
+    count = sum(len(codes) for codes in selected.values())
+    print(f"Archived {count} old code(s) to {CODES_ARCHIVE_PATH}")
+    return count
+
+
+def read_archived_codes():
+    """All archived code records"""
+    if not os.path.exists(CODES_ARCHIVE_PATH):
+        return []
+    with gzip.open(CODES_ARCHIVE_PATH, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def clear_archive(game_key=None):
+    """Forget archived codes for one game, or for all games"""
+    with state.lock, file_lock(CODES_ARCHIVE_LOCK_PATH):
+        load_archive_digest()
+        if game_key:
+            state.archive_digest.pop(game_key, None)
+            if os.path.exists(CODES_ARCHIVE_PATH):
+                remaining = [record for record in read_archived_codes() if record.get("game") != game_key]
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(CODES_ARCHIVE_PATH) or ".",
+                                                prefix=f"{os.path.basename(CODES_ARCHIVE_PATH)}.", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+                        f.writelines(json.dumps(record) + "\n" for record in remaining)
+                    os.replace(tmp_path, CODES_ARCHIVE_PATH)
+                except BaseException:
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+                    raise
+        else:
+            state.archive_digest = {}
+            if os.path.exists(CODES_ARCHIVE_PATH):
+                os.remove(CODES_ARCHIVE_PATH)
+        save_archive_digest()
+
+
+def record_sent_code(game_key, code, expiration=None):
+    """Mark a code as sent and append it to storage"""
+    with state.lock:
+        state.mark_code_sent(game_key, code, expiration)
+        start = time.monotonic()
+        code_store.add_code(game_key, code, expiration)
+        metrics.observe("hoyolab_save_sent_codes_duration_seconds", time.monotonic() - start)
+
+
+def compact_storage_if_due():
+    """Compact the sent codes store every storage_compact_interval seconds.
+
+    The last compaction time is kept on disk, so restarts (or a new leader) do not push it back.
+    """
+    global last_compaction
+    
+    stamp = file_stamp(COMPACTION_STAMP_PATH)
+    last_done = max(last_compaction, stamp[0] / 1e9 if stamp else 0)
+    if time.time() - last_done < state.config.get("storage_compact_interval", 86400):
+        return
+    last_compaction = time.time()
+    try:
+        archive_old_codes()
+        code_store.compact()
+        with open(COMPACTION_STAMP_PATH, 'w') as f:
+            f.write(datetime.now().isoformat())
+    except Exception as e:
+        print(f"Error compacting sent codes storage: {e}")
+
+
+def invalidate_status_cache(timezone_changed=False):
+    """Make the next /api/status call rebuild its response"""
+    with state.lock:
+        state.version += 1
+    if timezone_changed:
+        code_views.clear()
+
+
+def get_code_view(game_key, code, expiration):
+    """Parsed and formatted expiration for a code, computed once per code and timezone"""
+    view = code_views.get((game_key, code))
+    if view is None or view["expiration"] != expiration:
+        view = {"expiration": expiration, "date": None, "formatted": None}
+        if expiration:
+            try:
+                exp_date = date_parser.parse(expiration)
+                if exp_date.tzinfo is None:
+                    exp_date = pytz.UTC.localize(exp_date)
+                view["date"] = exp_date
+                view["formatted"] = exp_date.astimezone(get_user_timezone()).strftime("%b %d, %Y at %H:%M %Z")
+            except Exception:
+                pass
+        code_views[(game_key, code)] = view
+    return view
+
+
+def write_json_atomic(path, data, indent=2):
+    """Write JSON to a temporary file and move it into place, so readers never see a partial file.
+
+    The temporary file has a unique name, so workers writing the same file never share it.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_delivery_queue():
+    """Load pending and dead-lettered deliveries from file"""
+    global delivery_queue, delivery_queue_stamp
     ensure_data_dir()
     
-    if os.path.exists(CODES_PATH):
+    previous = delivery_queue
+    delivery_queue_stamp = file_stamp(DELIVERY_QUEUE_PATH)
+    if os.path.exists(DELIVERY_QUEUE_PATH):
         try:
-            with open(CODES_PATH, 'r') as f:
+            with open(DELIVERY_QUEUE_PATH, 'r') as f:
                 data = json.load(f)
-                # Support both old format (just codes) and new format (with expiration)
-                if isinstance(data, dict):
-                    # Check if it's new format with expiration data
-                    if "codes" in data and "expiration" in data:
-                        sent_codes = data["codes"]
-                        code_expiration_data = data["expiration"]
-                    else:
-                        # Old format - just game: [codes] structure
-                        sent_codes = data
-                        code_expiration_data = {"genshin": {}, "starrail": {}, "zenless": {}}
-                else:
-                    sent_codes = {"genshin": [], "starrail": [], "zenless": []}
-                    code_expiration_data = {"genshin": {}, "starrail": {}, "zenless": {}}
+            delivery_queue = {
+                "pending": data.get("pending", []),
+                "dead_letter": data.get("dead_letter", []),
+                "payloads": data.get("payloads", {})
+            }
+            # Queue files written before payloads were shared keep the payload in each entry
+            for entry in delivery_queue["pending"] + delivery_queue["dead_letter"]:
+                if "payload" in entry:
+                    entry["payload_id"] = entry["id"]
+                    delivery_queue["payloads"][entry["id"]] = entry.pop("payload")
+            # Deliveries this process is sending keep their in-memory entries, which run_deliveries updates
+            in_flight = {entry["id"]: entry for entry in previous["pending"] if entry["id"] in deliveries_in_flight}
+            pending = [in_flight.pop(entry["id"], entry) for entry in delivery_queue["pending"]]
+            delivery_queue["pending"] = pending + list(in_flight.values())
+            for entry in delivery_queue["pending"]:
+                if entry["id"] in deliveries_in_flight and entry["payload_id"] in previous["payloads"]:
+                    delivery_queue["payloads"].setdefault(entry["payload_id"], previous["payloads"][entry["payload_id"]])
+            if delivery_queue["pending"] and not previous["pending"]:
+                print(f"Resuming {len(delivery_queue['pending'])} queued webhook deliveries")
         except Exception as e:
-            print(f"Error loading sent codes: {e}")
-            sent_codes = {"genshin": [], "starrail": [], "zenless": []}
-            code_expiration_data = {"genshin": {}, "starrail": {}, "zenless": {}}
-    else:
-        sent_codes = {"genshin": [], "starrail": [], "zenless": []}
-        code_expiration_data = {"genshin": {}, "starrail": {}, "zenless": {}}
-        save_sent_codes()
+            print(f"Error loading delivery queue: {e}")
+            delivery_queue = {"pending": [], "dead_letter": [], "payloads": {}}
     
-    return sent_codes
+    return delivery_queue
 
 
-def save_sent_codes():
-    """Save sent codes to file"""
+def save_delivery_queue():
+    """Save the delivery queue to file, dropping payloads no entry references any more"""
+    global delivery_queue_stamp
     ensure_data_dir()
-    data = {
-        "codes": sent_codes,
-        "expiration": code_expiration_data
-    }
-    with open(CODES_PATH, 'w') as f:
-        json.dump(data, f, indent=2)
+    with delivery_queue_lock:
+        referenced = {entry["payload_id"] for entry in delivery_queue["pending"] + delivery_queue["dead_letter"]}
+        payloads = delivery_queue["payloads"]
+        for payload_id in [payload_id for payload_id in payloads if payload_id not in referenced]:
+            del payloads[payload_id]
+        write_json_atomic(DELIVERY_QUEUE_PATH, delivery_queue, indent=None)
+        delivery_queue_stamp = file_stamp(DELIVERY_QUEUE_PATH)
+
 
+def reload_delivery_queue_if_changed():
+    """Pick up queue changes written by another worker (e.g. a dead-letter retry request)"""
+    with delivery_queue_lock:
+        if file_stamp(DELIVERY_QUEUE_PATH) != delivery_queue_stamp:
+            load_delivery_queue()
 
-def fetch_codes(game_key):
-    """Fetch codes from API for a specific game"""
-    game_data = GAMES_DATA.get(game_key, {})
-    api_url = game_data.get("api_url")
+
+@contextmanager
+def locked_delivery_queue():
+    """Hold the delivery queue across threads and workers, with other workers' changes loaded first.
+
+    Every change that is saved is made under it, so no worker overwrites another's entries.
+    """
+    with delivery_queue_lock, file_lock(DELIVERY_QUEUE_LOCK_PATH):
+        reload_delivery_queue_if_changed()
+        yield
+
+
+def load_reminder_codes():
+    """Load the routing data of sent codes that still get expiration reminders"""
+    global reminder_codes
+    try:
+        with open(REMINDER_CODES_PATH, 'r') as f:
+            reminder_codes = json.load(f)
+    except FileNotFoundError:
+        reminder_codes = {}
+    except Exception as e:
+        print(f"Error loading reminder codes: {e}")
+        reminder_codes = {}
+
+
+def remember_reminder_codes(pairs, filtered=()):
+    """Keep what routed sent (game_key, code_data) pairs that expire, so reminders reach the same webhooks.
+
+    Filtered pairs, which no webhook accepted, are kept with an empty route so they get no reminders either.
+    """
+    now = time.time()
+    changed = False
+    for (game_key, code_data), routed in [(pair, True) for pair in pairs] + [(pair, False) for pair in filtered]:
+        expiration_date = parse_expiration_date(code_data)
+        if expiration_date is None:
+            continue
+        entry = {
+            "rewards": code_data.get("rewards", []),
+            "expiration": expiration_date.isoformat(),
+            "sent_at": now
+        }
+        if not routed:
+            entry["filtered"] = True
+        reminder_codes.setdefault(game_key, {})[code_data["code"]] = entry
+        changed = True
+    if not changed:
+        return
+    
+    # Expired codes get no more reminders
+    for game_key, codes in reminder_codes.items():
+        for code in [code for code, data in codes.items() if (parse_expiration_timestamp(data["expiration"]) or 0) < now]:
+            del codes[code]
+    try:
+        ensure_data_dir()
+        write_json_atomic(REMINDER_CODES_PATH, reminder_codes, indent=None)
+    except OSError as e:
+        print(f"Error saving reminder codes: {e}")
+
+
+def get_reminder_urls(routes, game_key, code, timestamp):
+    """Webhooks a reminder goes to: the ones the code's filters and rules routed it to when it was sent"""
+    stored = reminder_codes.get(game_key, {}).get(code)
+    if stored and stored.get("filtered"):
+        return {}
+    if stored:
+        code_data = {"code": code, "rewards": stored["rewards"], "expiration": stored["expiration"]}
+        return routes.match(game_key, code_data, stored["sent_at"])
+    # Sent before its routing data was kept: only webhooks that would accept a code without rewards
+    return routes.match(game_key, {"code": code, "expiration": datetime.fromtimestamp(timestamp, tz=pytz.UTC).isoformat()})
+
+
+def load_stats_outbox():
+    """Load statistics events that were not sent before the last shutdown"""
+    global stats_outbox
+    try:
+        with open(STATS_OUTBOX_PATH, 'r') as f:
+            events = json.load(f)
+    except FileNotFoundError:
+        events = []
+    except Exception as e:
+        print(f"Error loading statistics outbox: {e}")
+        events = []
+    with stats_outbox_lock:
+        stats_outbox = events if isinstance(events, list) else []
+        if stats_outbox:
+            print(f"Resuming {len(stats_outbox)} unsent statistics events")
+
+
+def save_stats_outbox():
+    """Save the statistics outbox to file"""
+    ensure_data_dir()
+    with stats_outbox_lock:
+        write_json_atomic(STATS_OUTBOX_PATH, stats_outbox, indent=None)
+
+
+def get_http_session():
+    """Shared keep-alive session used for every outbound request, pooled per host"""
+    global http_session
+    
+    with http_session_lock:
+        if http_session is None:
+            retries = state.config.get("http_retries", 2)
+            retry = Retry(
+                total=retries,
+                connect=retries,
+                read=0,
+                status=retries,
+                status_forcelist=[502, 503, 504],
+                allowed_methods=["GET", "HEAD"],
+                backoff_factor=0.5,
+                raise_on_status=False,
+                respect_retry_after_header=False  # Discord 429s are handled by the rate limiter
+            )
+            pool_size = max(state.config.get("http_pool_maxsize", 32), state.config.get("delivery_workers", 8))
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size, max_retries=retry)
+            
+            session = requests.Session()
+            session.headers["User-Agent"] = "HoyoLabCodeNotifier/1.0"
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            http_session = session
+        return http_session
+
+
+def get_http_timeout():
+    """Timeout for outbound requests"""
+    return state.config.get("http_timeout", 10)
+
+
+def get_fetch_headers(fetch_key):
+    """Conditional request headers from the validators of the last fetch"""
+    cached = fetch_validators.get(fetch_key, {})
+    headers = {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    return headers
+
+
+def parse_ennead_codes(source, response):
+    """api.ennead.cc: {"active": [{"code", "rewards", ...}], "inactive": [...]}"""
+    codes = response.json().get("active", [])
+    if not isinstance(codes, list):
+        raise ValueError("Invalid data format")
+    return codes
+
+
+def parse_json_codes(source, response):
+    """Generic JSON API: a list of codes (strings or objects) at the dotted "path" of the payload"""
+    data = response.json()
+    for key in filter(None, source.get("path", "").split(".")):
+        data = data.get(key, []) if isinstance(data, dict) else []
+    if not isinstance(data, list):
+        raise ValueError("Invalid data format")
+    
+    code_field = source.get("code_field", "code")
+    codes = []
+    for item in data:
+        if isinstance(item, str):
+            codes.append({"code": item})
+        elif isinstance(item, dict) and item.get(code_field):
+            codes.append({**item, "code": item[code_field]})
+    return codes
+
+
+def parse_html_codes(source, response):
+    """HoYoLab posts and community pages: codes matched by a regex, by default in redemption links"""
+    pattern = source.get("pattern", r"[?&]code=([A-Za-z0-9]{5,20})")
+    return [{"code": match} for match in re.findall(pattern, response.text)]
+
+
+# Source adapters by type: (source, response) -> list of code dicts
+SOURCE_ADAPTERS = {
+    "ennead": parse_ennead_codes,
+    "json": parse_json_codes,
+    "html": parse_html_codes,
+}
+FETCH_FAILED = object()  # Codes fetch_codes() returns for a failed fetch, which tells nothing about the game
+
+
+def get_sources(game_key):
+    """Sources queried for a game: the built-in API plus configured sources, which override it by name"""
+    sources = {}
+    api_url = GAMES_DATA.get(game_key, {}).get("api_url")
+    if api_url:
+        sources["ennead"] = {"name": "ennead", "type": "ennead", "url": api_url, "trusted": True}
     
-    if not api_url:
-        return []
+    for source in state.config.get("sources", []):
+        if source.get("games") and game_key not in source["games"]:
+            continue
+        merged = {**sources.get(source.get("name"), {}), **source}
+        if merged.get("url"):
+            merged["url"] = merged["url"].replace("{game}", game_key)
+        sources[merged.get("name")] = merged
+    
+    return [source for source in sources.values()
+            if source.get("enabled", True) and source.get("url") and source.get("type") in SOURCE_ADAPTERS]
+
+
+def validate_sources(sources):
+    """Raise ValueError for a source list the fetcher cannot use"""
+    if not isinstance(sources, list):
+        raise ValueError("sources must be a list")
+    names = set()
+    for source in sources:
+        if not isinstance(source, dict) or not source.get("name"):
+            raise ValueError("Each source needs a name")
+        if source["name"] in names:
+            raise ValueError(f"Duplicate source name: {source['name']}")
+        names.add(source["name"])
+        if source["name"] != "ennead" and source.get("type") not in SOURCE_ADAPTERS:
+            raise ValueError(f"Unknown source type for {source['name']}, expected one of: {', '.join(SOURCE_ADAPTERS)}")
+        if source["name"] != "ennead" and not source.get("url"):
+            raise ValueError(f"Source {source['name']} needs a url")
+        if "pattern" in source:
+            try:
+                re.compile(source["pattern"])
+            except re.error as e:
+                raise ValueError(f"Invalid pattern for {source['name']}: {e}")
+
+
+def normalize_codes(source, codes):
+    """Uppercase codes, drop empty and repeated ones, and tag each with the source that reported it"""
+    normalized = {}
+    for code_data in codes:
+        code = str(code_data.get("code") or "").strip().upper()
+        if code and code not in normalized:
+            normalized[code] = {**code_data, "code": code, "source": source["name"]}
+    return list(normalized.values())
+
+
+def parse_codes_response(game_key, source, response):
+    """Extract active codes from a source response, with the payload's validators.
+
+    Codes are None if the payload has not changed since the last processed fetch. The validators
+    are not stored here: the caller commits them once the codes have been handled, so a payload
+    whose result was dropped or failed is diffed again on the next fetch.
+    """
+    fetch_key = (game_key, source["name"])
+    if response.status_code == 304:
+        return None, None
+    
+    if response.status_code != 200:
+        raise ValueError(f"API returned {response.status_code}")
+    
+    # Identical body to last time: nothing to parse or diff
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "hash": content_hash
+    }
+    if content_hash == fetch_validators.get(fetch_key, {}).get("hash"):
+        return None, validators
+    
+    return normalize_codes(source, SOURCE_ADAPTERS[source["type"]](source, response)), validators
+
+
+def record_source_fetch(game_key, source_name, elapsed, response=None, error=None):
+    """Update a source's reliability and latency score and the fetch metrics after a fetch"""
+    metrics.observe("hoyolab_fetch_duration_seconds", elapsed, game=game_key, source=source_name)
+    metrics.inc("hoyolab_upstream_responses_total", source=source_name,
+                status=response.status_code if response is not None else "error")
+    if response is not None:
+        metrics.inc("hoyolab_fetch_bytes_total", len(response.content), source=source_name)
+    
+    with source_stats_lock:
+        stats = source_stats.setdefault(source_name, {
+            "fetches": 0, "failures": 0, "avg_latency": None, "first_reports": 0, "last_error": None
+        })
+        stats["fetches"] += 1
+        if error:
+            stats["failures"] += 1
+            stats["last_error"] = error
+        else:
+            # Moving average, so a source that got slower recently is noticed
+            previous = stats["avg_latency"]
+            stats["avg_latency"] = elapsed if previous is None else previous * 0.8 + elapsed * 0.2
+
+
+def record_first_report(source_name):
+    """Credit a source with being the one a new code was sent from"""
+    with source_stats_lock:
+        source_stats.setdefault(source_name, {
+            "fetches": 0, "failures": 0, "avg_latency": None, "first_reports": 0, "last_error": None
+        })["first_reports"] += 1
+
+
+def get_source_scores():
+    """Per source fetch statistics with a reliability ratio"""
+    with source_stats_lock:
+        return {
+            name: {
+                **stats,
+                "reliability": round(1 - stats["failures"] / stats["fetches"], 3) if stats["fetches"] else None,
+                "avg_latency": round(stats["avg_latency"], 3) if stats["avg_latency"] is not None else None
+            }
+            for name, stats in source_stats.items()
+        }
+
+
+def describe_error(error):
+    """Message of an exception, or its type for exceptions without one (e.g. timeouts)"""
+    return str(error) or type(error).__name__
+
+
+def finish_fetch(game_key, source, start, response=None, error=None):
+    """(codes, validators) of a fetch once its request returned a response or raised error, for both engines"""
+    if error is None:
+        try:
+            result = parse_codes_response(game_key, source, response)
+        except Exception as e:
+            error = e
+    if error is not None:
+        print(f"Error fetching codes for {game_key} from {source['name']}: {error}")
+        record_source_fetch(game_key, source["name"], time.monotonic() - start, response, describe_error(error))
+        return FETCH_FAILED, None
     
+    record_source_fetch(game_key, source["name"], time.monotonic() - start, response)
+    return result
+
+
+def fetch_codes(game_key, source):
+    """Fetch (codes, validators) for a game from one source, see parse_codes_response(); codes are FETCH_FAILED on error"""
+    start = time.monotonic()
     try:
-        response = requests.get(api_url, headers={
-            "User-Agent": "HoyoLabCodeNotifier/1.0"
-        }, timeout=10)
-        
-        if response.status_code != 200:
-            print(f"API returned {response.status_code} for {game_key}")
-            return []
-        
-        data = response.json()
-        codes = data.get("active", [])
-        
-        if not isinstance(codes, list):
-            print(f"Invalid data format for {game_key}")
-            return []
-        
-        return codes
+        response = get_http_session().get(
+            source["url"], headers=get_fetch_headers((game_key, source["name"])), timeout=get_http_timeout()
+        )
     except Exception as e:
-        print(f"Error fetching codes for {game_key}: {e}")
-        return []
+        return finish_fetch(game_key, source, start, error=e)
+    return finish_fetch(game_key, source, start, response)
+
+
+def fetch_all_codes(game_keys, get_wake_time=None):
+    """Fetch codes for several games from all their sources concurrently, yielding (game_key, source, codes, validators) as each one arrives.
+
+    get_wake_time() may return a monotonic time at which the caller wants control back even if no
+    fetch has finished by then; None is yielded at that time.
+    """
+    jobs = [(game_key, source) for game_key in game_keys for source in get_sources(game_key)]
+    if not jobs:
+        return
+    
+    deadline = time.monotonic() + state.config.get("fetch_deadline", 20)
+    executor = None
+    pipeline = get_async_pipeline()
+    if pipeline:
+        futures = {pipeline.submit(pipeline.fetch_codes(*job)): job for job in jobs}
+    else:
+        executor = ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="fetch")
+        futures = {executor.submit(fetch_codes, *job): job for job in jobs}
+    pending = set(futures)
+    
+    try:
+        while pending:
+            # Results that are already done are still handed out once the deadline has passed
+            timeout = max(0, deadline - time.monotonic())
+            wake_at = get_wake_time() if get_wake_time else None
+            if wake_at is not None:
+                timeout = max(0, min(timeout, wake_at - time.monotonic()))
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done and time.monotonic() < deadline:
+                yield None
+                continue
+            if not done:
+                skipped = ", ".join(f"{futures[f][0]} ({futures[f][1]['name']})" for f in pending)
+                print(f"Fetch deadline reached, skipping this cycle: {skipped}")
+                break
+            for future in done:
+                yield (*futures[future], *future.result())
+    finally:
+        for future in pending:
+            future.cancel()
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 
 def parse_expiration_date(code_data):
@@ -235,11 +1835,13 @@ def get_expiration_status(expiration_date):
 
 def get_user_timezone():
     """Get the configured timezone"""
-    tz_name = config.get("timezone", "UTC")
-    try:
-        return pytz.timezone(tz_name)
-    except:
-        return pytz.UTC
+    tz_name = state.config.get("timezone", "UTC")
+    if tz_name not in timezone_cache:
+        try:
+            timezone_cache[tz_name] = pytz.timezone(tz_name)
+        except:
+            timezone_cache[tz_name] = pytz.UTC
+    return timezone_cache[tz_name]
 
 
 def format_expiration_for_discord(expiration_date):
@@ -273,184 +1875,1290 @@ def format_expiration_for_discord(expiration_date):
         return f"\n\n{emoji} ⏰ Expires: **{formatted_time} {tz_abbr}**"
 
 
-def send_discord_notification(game_key, code_data):
-    """Send Discord webhook notification to all configured webhooks"""
-    # Get all webhook URLs for this game
-    webhook_urls = get_webhooks_for_game(game_key)
-    
-    if not webhook_urls:
-        print(f"No webhook URLs configured for {game_key}")
-        return False
+# Discord message limits
+MESSAGE_EMBED_LIMIT = 10  # Embeds per message
+MESSAGE_CHAR_LIMIT = 6000  # Combined title, description and footer length of all embeds in a message
+EMBED_TITLE_LIMIT = 256
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBED_FOOTER_LIMIT = 2048
+
+# Notification template: message fields use the game placeholders, embed fields also the code ones
+DEFAULT_TEMPLATE = {
+    "username": "{mascot}",
+    "avatar_url": "{mascot_avatar}",
+    "content": "",
+    "title": "🎁 New Code Available for {game}!",
+    "description": "**Code:** `{code}`{rewards_line}\n\n**Redeem Link:**\n{redeem_link}{expiration}",
+    "footer": "HoYoLab Code Notifier"
+}
+TEMPLATE_GAME_FIELDS = {"game", "game_key", "mascot", "mascot_avatar"}
+TEMPLATE_CODE_FIELDS = {"code", "rewards", "rewards_line", "redeem_link", "expiration"}
+TEMPLATE_MESSAGE_KEYS = {"username", "avatar_url", "content"}
+# Every placeholder value is a string: templates are rendered once with these to catch bad format specs
+TEMPLATE_SAMPLE_VALUES = {field: "SAMPLE" for field in TEMPLATE_GAME_FIELDS | TEMPLATE_CODE_FIELDS}
+TEMPLATE_RENDER_ERRORS = (ValueError, KeyError, IndexError, AttributeError, TypeError)
+
+
+def get_mascot(game_key):
+    """Game-specific mascot name and avatar used as the webhook identity"""
+    return MASCOTS.get(game_key, {"name": "HoYoLab", "avatar": ""})
+
+
+def format_rewards(rewards):
+    """Rewards as a comma separated list"""
+    reward_items = []
+    for reward in rewards or []:
+        if isinstance(reward, dict):
+            name = reward.get("name", "Unknown")
+            count = reward.get("count", 1)
+            reward_items.append(f"{name} x{count}")
+        else:
+            reward_items.append(str(reward))
+    return ", ".join(reward_items)
+
+
+def compile_template(template):
+    """Validate a webhook template and merge it over the default one; returns (key, template) or raises ValueError"""
+    template = template or {}
+    key = json.dumps(template, sort_keys=True)
+    if key in compiled_templates:
+        return key, compiled_templates[key]
+    
+    if not isinstance(template, dict):
+        raise ValueError("Template must be an object")
+    for name, text in template.items():
+        if name == "color":
+            if not isinstance(text, int):
+                raise ValueError("Template color must be an integer")
+            continue
+        if name not in DEFAULT_TEMPLATE:
+            raise ValueError(f"Unknown template field: {name}")
+        if not isinstance(text, str):
+            raise ValueError(f"Template {name} must be a string")
+        
+        allowed = TEMPLATE_GAME_FIELDS if name in TEMPLATE_MESSAGE_KEYS else TEMPLATE_GAME_FIELDS | TEMPLATE_CODE_FIELDS
+        try:
+            fields = {field for _, field, _, _ in string.Formatter().parse(text) if field is not None}
+        except ValueError as e:
+            raise ValueError(f"Invalid template {name}: {e}")
+        unknown = fields - allowed
+        if unknown:
+            raise ValueError(f"Unknown placeholder(s) in template {name}: {', '.join(sorted(unknown))}")
+        try:
+            text.format_map(TEMPLATE_SAMPLE_VALUES)
+        except TEMPLATE_RENDER_ERRORS as e:
+            raise ValueError(f"Invalid template {name}: {e}")
     
-    game_data = GAMES_DATA.get(game_key, {})
-    game_name = game_data.get("name", game_key)
-    redeem_url = game_data.get("redeem_url", "")
+    compiled_templates[key] = {**DEFAULT_TEMPLATE, **template}
+    return key, compiled_templates[key]
+
+
+def get_game_values(game_key):
+    """Template values that only depend on the game"""
+    mascot = get_mascot(game_key)
+    return {
+        "game": GAMES_DATA.get(game_key, {}).get("name", "HoYoverse"),
+        "game_key": game_key or "",
+        "mascot": mascot["name"],
+        "mascot_avatar": mascot["avatar"]
+    }
+
+
+def get_code_values(game_key, code_data):
+    """Template values for one code, rendered once per notification whatever the number of webhooks"""
     code = code_data.get("code", "")
-    rewards = code_data.get("rewards", [])
-    
-    # Parse and store expiration date
-    expiration_date = parse_expiration_date(code_data)
-    expiration_text = format_expiration_for_discord(expiration_date)
-    
-    # Store expiration data
-    if expiration_date:
-        if game_key not in code_expiration_data:
-            code_expiration_data[game_key] = {}
-        code_expiration_data[game_key][code] = expiration_date.isoformat()
-    
-    # Game-specific mascot names and avatars
-    mascot_data = {
-        "genshin": {
-            "name": "Paimon",
-            "avatar": "https://fastcdn.hoyoverse.com/static-resource-v2/2023/11/08/9db76fb146f82c045bc276956f86e047_6878380451593228482.png"
-        },
-        "starrail": {
-            "name": "PomPom",
-            "avatar": "https://fastcdn.hoyoverse.com/static-resource-v2/2025/09/24/de09aa694c26b87448cf03af683e3109_6737621355140099473.jpg"
-        },
-        "zenless": {
-            "name": "Eous",
-            "avatar": "https://hyl-static-res-prod.hoyolab.com/communityweb/business/nap.png"
-        }
+    rewards = format_rewards(code_data.get("rewards", []))
+    return {
+        **get_game_values(game_key),
+        "code": code,
+        "rewards": rewards,
+        "rewards_line": f"\n**Rewards:** {rewards}" if rewards else "",
+        "redeem_link": f"{GAMES_DATA.get(game_key, {}).get('redeem_url', '')}{code}",
+        "expiration": format_expiration_for_discord(parse_expiration_date(code_data))
     }
-    
-    mascot = mascot_data.get(game_key, {"name": "HoYoLab", "avatar": ""})
-    
-    # Build reward string
-    reward_str = ""
-    if rewards:
-        reward_items = []
-        for reward in rewards:
-            if isinstance(reward, dict):
-                name = reward.get("name", "Unknown")
-                count = reward.get("count", 1)
-                reward_items.append(f"{name} x{count}")
-            else:
-                reward_items.append(str(reward))
-        reward_str = "\n**Rewards:** " + ", ".join(reward_items)
-    
-    # Create embed for Discord
-    embed = {
-        "title": f"🎁 New Code Available for {game_name}!",
-        "description": f"**Code:** `{code}`{reward_str}\n\n**Redeem Link:**\n{redeem_url}{code}{expiration_text}",
-        "color": get_game_color(game_key),
-        "timestamp": datetime.utcnow().isoformat(),
+
+
+def get_message_identity(template_key, template, game_key):
+    """Precompiled message fields (username, avatar, content) of a template for one game, or mixed games if None"""
+    cache_key = (template_key, game_key)
+    if cache_key not in message_identities:
+        values = get_game_values(game_key)
+        rendered = {field: template[field].format_map(values) for field in ("username", "avatar_url", "content")}
+        message_identities[cache_key] = {field: text for field, text in rendered.items() if text}
+    return message_identities[cache_key]
+
+
+def render_embed(template, game_key, values, timestamp):
+    """Discord embed announcing one code"""
+    return {
+        "title": template["title"].format_map(values)[:EMBED_TITLE_LIMIT],
+        "description": template["description"].format_map(values)[:EMBED_DESCRIPTION_LIMIT],
+        "color": template.get("color", get_game_color(game_key)),
+        "timestamp": timestamp,
         "footer": {
-            "text": "HoYoLab Code Notifier"
+            "text": template["footer"].format_map(values)[:EMBED_FOOTER_LIMIT]
         }
     }
-    
-    payload = {
-        "username": mascot["name"],
-        "avatar_url": mascot["avatar"],
-        "embeds": [embed]
+
+
+def embed_length(embed):
+    """Characters of an embed that count towards Discord's per-message limit"""
+    return len(embed.get("title", "")) + len(embed.get("description", "")) + len(embed.get("footer", {}).get("text", ""))
+
+
+def pack_embeds(items):
+    """Split (game_key, code_data, embed) items into as few messages as Discord's embed and character limits allow"""
+    messages = []
+    current, current_length = [], 0
+    for item in items:
+        length = embed_length(item[2])
+        if current and (len(current) >= MESSAGE_EMBED_LIMIT or current_length + length > MESSAGE_CHAR_LIMIT):
+            messages.append(current)
+            current, current_length = [], 0
+        current.append(item)
+        current_length += length
+    if current:
+        messages.append(current)
+    return messages
+
+
+def build_message(template_key, template, items, mentions=()):
+    """Webhook payload for a group of (game_key, code_data, embed) items, with mentions put before the content"""
+    game_keys = list(dict.fromkeys(game_key for game_key, _, _ in items))
+    # Mixed-game messages cannot use one game's mascot
+    identity = get_message_identity(template_key, template, game_keys[0] if len(game_keys) == 1 else None)
+    message = {
+        **identity,
+        "embeds": [embed for _, _, embed in items]
     }
-    
-    # Send to all webhooks
-    success_count = 0
-    for webhook_url in webhook_urls:
+    if mentions:
+        message["content"] = " ".join(mentions + ((identity["content"],) if identity.get("content") else ()))
+    return message
+
+
+def render_webhook_embeds(template_key, template, items, embeds, timestamp):
+    """(game_key, code_data, embed) items of a webhook, reusing embeds already rendered with the same template"""
+    matching = []
+    for game_key, code_data, values in items:
+        embed_key = (template_key, game_key, code_data["code"])
+        if embed_key not in embeds:
+            embeds[embed_key] = render_embed(template, game_key, values, timestamp)
+        matching.append((game_key, code_data, embeds[embed_key]))
+    # Message identities are rendered here too, so a failing template is caught before anything is queued
+    for game_key in {game_key for game_key, _, _ in items} | {None}:
+        get_message_identity(template_key, template, game_key)
+    return matching
+
+
+def get_webhook_template(webhook):
+    """Compiled template of a webhook, falling back to the default one if it is invalid"""
+    try:
+        return compile_template(webhook.get("template"))
+    except ValueError as e:
+        print(f"Ignoring template of webhook {webhook.get('name', '')}: {e}")
+        return compile_template(None)
+
+
+@timed("hoyolab_notification_duration_seconds")
+def send_code_notifications(new_codes):
+    """Notify every webhook of new (game_key, code_data) pairs, batched per webhook.
+
+    Returns the pairs that were queued, and the pairs no webhook's filters or rules accepted.
+    """
+    game_order = list(GAMES_DATA)
+    # Same-game codes next to each other, so most batches keep their game's mascot
+    items = sorted(
+        ((game_key, code_data, get_code_values(game_key, code_data)) for game_key, code_data in new_codes),
+        key=lambda item: game_order.index(item[0]) if item[0] in game_order else len(game_order)
+    )
+    timestamp = datetime.utcnow().isoformat()
+    
+    # Embeds and payloads are rendered once per template and shared by every webhook using it,
+    # so each distinct message is also serialized only once
+    embeds = {}
+    payloads = {}
+    # Destinations of each code come from the routing index, not from a scan of every webhook
+    routes = state.routes
+    webhook_items = {}
+    mentions = {}  # (url, game_key, code) -> mention added by the webhook's rules
+    for item in items:
+        for url, mention in routes.match(item[0], item[1]).items():
+            webhook_items.setdefault(url, []).append(item)
+            if mention:
+                mentions[(url, item[0], item[1]["code"])] = mention
+    
+    deliveries = []
+    delivery_codes = []  # (game_key, code) pairs in each delivery
+    queued = set()
+    for url in sorted(webhook_items, key=routes.order.get):
+        webhook = routes.by_url[url]
+        template_key, template = get_webhook_template(webhook)
         try:
-            response = requests.post(webhook_url, json=payload, timeout=10)
-            if response.status_code in [200, 204]:
-                print(f"Notification sent to webhook for {game_name}: {code}")
-                success_count += 1
-            else:
-                print(f"Failed to send webhook: {response.status_code}")
-        except Exception as e:
-            print(f"Error sending webhook: {e}")
+            matching = render_webhook_embeds(template_key, template, webhook_items[url], embeds, timestamp)
+        except TEMPLATE_RENDER_ERRORS as e:
+            # One webhook's template must not stop delivery to the others
+            print(f"Template of webhook {webhook.get('name', '')} failed to render, using the default one: {e}")
+            template_key, template = compile_template(None)
+            matching = render_webhook_embeds(template_key, template, webhook_items[url], embeds, timestamp)
         
-        # Rate limit between webhooks
-        if len(webhook_urls) > 1:
-            time.sleep(0.5)
-    
-    # Send to statistics backend after successful Discord notification
+        groups = pack_embeds(matching) if webhook.get("batch_codes", True) else [[item] for item in matching]
+        for group in groups:
+            group_mentions = tuple(dict.fromkeys(
+                mentions[(url, game_key, code_data["code"])] for game_key, code_data, _ in group
+                if (url, game_key, code_data["code"]) in mentions
+            ))
+            payload_key = (template_key, tuple((game_key, code_data["code"]) for game_key, code_data, _ in group), group_mentions)
+            if payload_key not in payloads:
+                payloads[payload_key] = build_message(template_key, template, group, group_mentions)
+            delivery_codes.append(payload_key[1])
+            deliveries.append({
+                "url": webhook["url"],
+                "payload": payloads[payload_key],
+                "game": ", ".join(dict.fromkeys(game_key for game_key, _, _ in group)),
+                "code": ", ".join(code_data["code"] for _, code_data, _ in group)
+            })
+        queued.update((game_key, code_data["code"]) for game_key, code_data, _ in matching)
+    
+    filtered = []
+    for game_key, code_data, _ in items:
+        if (game_key, code_data["code"]) in queued:
+            continue
+        if routes.urls_for_game(game_key):
+            print(f"Code {code_data['code']} for {game_key} matched no webhook filters or rules")
+            filtered.append((game_key, code_data))
+        else:
+            print(f"No webhook URLs configured for {game_key}")
+    if not deliveries:
+        return [], filtered
+    
+    # Queue every delivery before sending, so failed or interrupted sends are retried
+    # for those webhooks only instead of re-sending the codes to everyone
+    entries = enqueue_deliveries(deliveries)
+    results = run_deliveries(entries)
+    success_count = sum(1 for result in results if result["success"])
+    
+    # Detection to delivery latency, counted at each code's first successful message
+    delivered_at = time.monotonic()
+    for pairs, result in zip(delivery_codes, results):
+        if not result["success"]:
+            continue
+        for game_key, code in pairs:
+            first_seen = code_first_seen.pop((game_key, code), None)
+            if first_seen is not None:
+                metrics.observe("hoyolab_code_delivery_latency_seconds", delivered_at - first_seen, game=game_key)
+    print(f"{len(queued)} new code(s) delivered in {success_count}/{len(results)} message(s) "
+          f"(slowest {max(result['elapsed'] for result in results):.2f}s)")
+    
+    # Report delivered codes to the statistics backend in the background, off the delivery path
     if success_count > 0:
-        try:
-            stats_payload = {
+        events = []
+        for game_key, code_data, values in items:
+            if (game_key, code_data["code"]) not in queued:
+                continue
+            expiration_date = parse_expiration_date(code_data)
+            events.append({
                 "game": game_key,
-                "code": code,
-                "rewards": reward_str.replace("\n**Rewards:** ", "") if reward_str else "",
+                "code": code_data["code"],
+                "rewards": values["rewards"],
                 "expiration_date": expiration_date.isoformat() if expiration_date else None
-            }
-            requests.post(
-                "https://hoyolab-backend.satrawi.cc/api/webhook/code-discovered",
-                json=stats_payload,
-                timeout=5
-            )
-            print(f"Code {code} sent to statistics backend")
+            })
+        enqueue_stats_events(events)
+    
+    # Webhooks that failed stay in the delivery queue, so the codes count as handled
+    return [(game_key, code_data) for game_key, code_data, _ in items if (game_key, code_data["code"]) in queued], filtered
+
+
+def enqueue_stats_events(events):
+    """Add statistics events to the persistent outbox and wake the reporter thread"""
+    if not events or not state.config.get("stats_endpoint"):
+        return
+    with stats_outbox_lock:
+        stats_outbox.extend({"payload": event, "attempts": 0} for event in events)
+        dropped = len(stats_outbox) - STATS_OUTBOX_LIMIT
+        if dropped > 0:
+            del stats_outbox[:dropped]
+            print(f"Statistics outbox full, dropped {dropped} oldest event(s)")
+        save_stats_outbox()
+    start_stats_reporter()
+    stats_wake.set()
+
+
+def flush_stats_outbox():
+    """Send the outbox in batches; returns the time of the next attempt after a failure, else 0"""
+    endpoint = state.config.get("stats_endpoint")
+    batch_size = max(1, state.config.get("stats_batch_size", 1))
+    max_attempts = state.config.get("delivery_max_attempts", 6)
+    with stats_outbox_lock:
+        pending = list(stats_outbox)
+    if not pending:
+        return 0
+    
+    sent = []
+    failed, error = [], None
+    if endpoint:
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            payload = batch[0]["payload"] if batch_size == 1 else [event["payload"] for event in batch]
+            try:
+                response = get_http_session().post(endpoint, json=payload, timeout=get_http_timeout())
+                error = None if response.ok else f"Statistics backend returned {response.status_code}"
+            except Exception as e:
+                error = str(e)
+            if error is not None:
+                # The backend is failing: back off and leave the rest of the outbox for the retry
+                failed = batch
+                break
+            sent.extend(batch)
+    else:
+        sent = pending  # Reporting was disabled meanwhile
+    
+    # Entries are shared with enqueue_stats_events(): they are only changed, removed and saved under the lock
+    retry_at = 0
+    with stats_outbox_lock:
+        given_up = []
+        if failed:
+            for event in failed:
+                event["attempts"] += 1
+            given_up = [event for event in failed if event["attempts"] >= max_attempts]
+            print(f"Failed to send {len(failed)} event(s) to statistics backend: {error}"
+                  + (f", dropped {len(given_up)} after {max_attempts} attempts" if given_up else ""))
+            retry_at = time.time() + get_retry_delay(max(event["attempts"] for event in failed))
+        done = {id(event) for event in sent + given_up}
+        if done:
+            stats_outbox[:] = [event for event in stats_outbox if id(event) not in done]
+        save_stats_outbox()
+    if endpoint and sent:
+        print(f"{len(sent)} code(s) sent to statistics backend")
+    return retry_at
+
+
+def stats_loop():
+    """Background thread sending the statistics outbox, so reporting never delays webhook deliveries"""
+    retry_at = 0
+    while not stop_checker.is_set():
+        if not stats_outbox:
+            stats_wake.wait()
+        stats_wake.clear()
+        if stop_checker.is_set():
+            break
+        # Collect the events of a whole check into one flush, and respect the backoff after a failure
+        if stop_checker.wait(max(state.config.get("stats_flush_interval", 5), retry_at - time.time())):
+            break
+        try:
+            retry_at = flush_stats_outbox()
         except Exception as e:
-            print(f"Failed to send to statistics backend: {e}")
-    
-    return success_count > 0
+            print(f"Error in statistics reporter: {e}")
+            retry_at = time.time() + get_retry_delay(1)
+
+
+def start_stats_reporter():
+    """Start the statistics reporter thread unless it is already running"""
+    global stats_thread
+    
+    with stats_outbox_lock:
+        if stats_thread is not None and stats_thread.is_alive():
+            return
+        stats_thread = threading.Thread(target=stats_loop, daemon=True)
+        stats_thread.start()
+
+
+def format_reminder_lead(hours):
+    """Reminder threshold as text, e.g. 24h or 30m"""
+    return f"{hours:g}h" if hours >= 1 else f"{hours * 60:g}m"
+
+
+def send_expiration_reminders():
+    """Remind webhooks of sent codes that reached a reminder threshold before expiring"""
+    state.reindex_expirations_if_needed()
+    due = {}
+    for game_key, code, hours, timestamp in state.expiration_index.pop_reminders():
+        # Several thresholds can fall due together after downtime: only the closest one is sent
+        if (game_key, code) not in due or hours < due[(game_key, code)][0]:
+            due[(game_key, code)] = (hours, timestamp)
+    if not due:
+        return
+    
+    template_key, template = compile_template(None)
+    timestamp_now = datetime.utcnow().isoformat()
+    items = []
+    for (game_key, code), (hours, timestamp) in due.items():
+        game_data = GAMES_DATA.get(game_key, {})
+        expiration_text = format_expiration_for_discord(datetime.fromtimestamp(timestamp, tz=pytz.UTC))
+        items.append((game_key, {"code": code, "expires_at": timestamp}, {
+            "title": f"⏳ {game_data.get('name', game_key)} code expires in {format_reminder_lead(hours)}!",
+            "description": f"**Code:** `{code}`\n\n**Redeem Link:**\n{game_data.get('redeem_url', '')}{code}"
+                           f"{expiration_text}"[:EMBED_DESCRIPTION_LIMIT],
+            "color": get_game_color(game_key),
+            "timestamp": timestamp_now,
+            "footer": {"text": DEFAULT_TEMPLATE["footer"]}
+        }))
+    game_order = list(GAMES_DATA)
+    items.sort(key=lambda item: game_order.index(item[0]) if item[0] in game_order else len(game_order))
+    
+    routes = state.routes
+    webhook_items = {}
+    for item in items:
+        for url in get_reminder_urls(routes, item[0], item[1]["code"], item[1]["expires_at"]):
+            webhook_items.setdefault(url, []).append(item)
+    
+    deliveries = []
+    for url in sorted(webhook_items, key=routes.order.get):
+        webhook = routes.by_url[url]
+        if not webhook.get("reminders", True):
+            continue
+        for group in pack_embeds(webhook_items[url]):
+            deliveries.append({
+                "url": webhook["url"],
+                "payload": build_message(template_key, template, group),
+                "game": ", ".join(dict.fromkeys(game_key for game_key, _, _ in group)),
+                "code": "reminder: " + ", ".join(code_data["code"] for _, code_data, _ in group)
+            })
+    
+    print(f"Sending expiration reminders for {len(items)} code(s)")
+    run_deliveries(enqueue_deliveries(deliveries))
+
+
+def describe_webhook(url):
+    """Short, token-free label for a webhook URL in logs"""
+    parts = url.rstrip("/").split("/")
+    if len(parts) >= 3 and parts[-3] == "webhooks":
+        return f"webhooks/{parts[-2]}"
+    return parts[2] if len(parts) > 2 else url
+
+
+class WebhookRateLimiter:
+    """Per-webhook token buckets learned from Discord's X-RateLimit-* response headers.
+
+    Until Discord has told us the limits for a webhook, sends to it are spaced by
+    webhook_min_interval. Once a response carries rate-limit headers, the webhook
+    is mapped to its Discord bucket and sends use the whole allowed budget per window.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.url_buckets = {}  # webhook route -> Discord bucket hash
+        self.buckets = {}  # (bucket hash, webhook route) -> {limit, remaining, reset_at, window}
+        self.next_slot = {}  # webhook route -> earliest send time while the bucket is unknown
+        self.in_flight = {}  # webhook route -> sends reserved but not answered yet
+        self.global_until = 0
+
+    @staticmethod
+    def route(url):
+        """Rate limits apply per webhook, regardless of query parameters"""
+        return url.split("?", 1)[0].rstrip("/")
+
+    def reserve(self, url):
+        """Take a send slot for this webhook, returning how long to wait before it is valid (0 = send now)"""
+        route = self.route(url)
+        with self.lock:
+            now = time.monotonic()
+            if now < self.global_until:
+                return self.global_until - now
+            
+            bucket_hash = self.url_buckets.get(route)
+            if bucket_hash is None:
+                slot = max(now, self.next_slot.get(route, 0))
+                if slot > now:
+                    return slot - now
+                self.next_slot[route] = now + state.config.get("webhook_min_interval", 0.5)
+                self.in_flight[route] = self.in_flight.get(route, 0) + 1
+                return 0
+            
+            bucket = self.buckets[(bucket_hash, route)]
+            if now >= bucket["reset_at"]:
+                bucket["remaining"] = bucket["limit"]
+                bucket["reset_at"] = now + bucket["window"]
+            if bucket["remaining"] > 0:
+                bucket["remaining"] -= 1
+                self.in_flight[route] = self.in_flight.get(route, 0) + 1
+                return 0
+            return bucket["reset_at"] - now
+
+    def acquire(self, url):
+        """Block until a send slot for this webhook is available"""
+        while True:
+            delay = self.reserve(url)
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    async def acquire_async(self, url):
+        """Wait without blocking the event loop until a send slot for this webhook is available"""
+        while True:
+            delay = self.reserve(url)
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def release(self, url):
+        """Give back a reserved slot whose request never got a response"""
+        route = self.route(url)
+        with self.lock:
+            self.in_flight[route] = max(0, self.in_flight.get(route, 0) - 1)
+
+    def update(self, url, response):
+        """Learn the webhook's bucket state from a response; returns the retry delay for a 429, else None"""
+        route = self.route(url)
+        headers = response.headers
+        with self.lock:
+            now = time.monotonic()
+            in_flight = self.in_flight[route] = max(0, self.in_flight.get(route, 0) - 1)
+            bucket_hash = headers.get("X-RateLimit-Bucket")
+            if bucket_hash and headers.get("X-RateLimit-Limit") and headers.get("X-RateLimit-Reset-After"):
+                try:
+                    limit = int(headers["X-RateLimit-Limit"])
+                    remaining = int(headers.get("X-RateLimit-Remaining", limit))
+                    reset_after = float(headers["X-RateLimit-Reset-After"])
+                    self.url_buckets[route] = bucket_hash
+                    bucket = self.buckets.setdefault((bucket_hash, route), {"window": reset_after})
+                    bucket["limit"] = limit
+                    bucket["window"] = max(bucket["window"], reset_after)
+                    bucket["reset_at"] = now + reset_after
+                    # Sends still in flight are not reflected in this response yet
+                    bucket["remaining"] = max(0, remaining - in_flight)
+                except ValueError:
+                    pass
+            
+            if response.status_code != 429:
+                return None
+            
+            retry_after = None
+            try:
+                body = response.json()
+                retry_after = float(body.get("retry_after"))
+                is_global = bool(body.get("global"))
+            except Exception:
+                is_global = False
+            if retry_after is None:
+                try:
+                    retry_after = float(headers.get("Retry-After", 1))
+                except ValueError:
+                    retry_after = 1.0
+            is_global = is_global or headers.get("X-RateLimit-Global", "").lower() == "true"
+            
+            if is_global:
+                self.global_until = max(self.global_until, now + retry_after)
+            elif route in self.url_buckets:
+                bucket = self.buckets[(self.url_buckets[route], route)]
+                bucket["remaining"] = 0
+                bucket["reset_at"] = max(bucket["reset_at"], now + retry_after)
+            else:
+                self.next_slot[route] = max(self.next_slot.get(route, 0), now + retry_after)
+            return retry_after
 
 
-def get_webhooks_for_game(game_key):
-    """Get all webhook URLs that have this game enabled"""
-    webhook_urls = []
-    
-    webhooks = config.get("webhooks", [])
-    for webhook in webhooks:
-        if isinstance(webhook, dict):
-            url = webhook.get("url", "")
-            games = webhook.get("games", {})
-            # Check if this game is enabled for this webhook
-            if url and games.get(game_key, False):
-                webhook_urls.append(url)
+webhook_rate_limiter = WebhookRateLimiter()
+
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def encode_payloads(jobs):
+    """Serialize each distinct payload of (url, payload) jobs once; jobs sharing a payload share its bytes"""
+    bodies = {}
+    encoded = []
+    for url, payload in jobs:
+        if id(payload) not in bodies:
+            bodies[id(payload)] = payload if isinstance(payload, bytes) else \
+                json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        encoded.append((url, bodies[id(payload)]))
+    return encoded
+
+
+def new_webhook_result(url):
+    """Outcome of the POSTs of one payload to a webhook, filled in by record_webhook_response/error()"""
+    return {"url": url, "success": False, "status": None, "error": None, "rate_limited": 0}
+
+
+def record_webhook_response(result, response):
+    """Record a webhook's response in result; returns whether the POST should be made again"""
+    url = result["url"]
+    result["status"] = response.status_code
+    retry_after = webhook_rate_limiter.update(url, response)
+    if response.status_code in [200, 204]:
+        result["success"] = True
+        result["error"] = None
+        return False
     
-    return webhook_urls
+    result["error"] = f"Webhook returned {response.status_code}"
+    if retry_after is None:
+        return False
+    # 429: the limiter now holds this webhook back until Discord's retry_after has passed
+    result["rate_limited"] += 1
+    return True
 
 
-def get_game_color(game_key):
-    """Get embed color for each game"""
-    colors = {
-        "genshin": 0x00BFFF,    # Light blue
-        "starrail": 0x9B59B6,   # Purple
-        "zenless": 0xF1C40F     # Yellow
-    }
-    return colors.get(game_key, 0x7289DA)
+def record_webhook_error(result, error):
+    """Record a POST that raised instead of returning a response; it is not retried here"""
+    webhook_rate_limiter.release(result["url"])
+    result["error"] = describe_error(error)
+
+
+def finish_webhook_result(result, start):
+    """Result of a webhook delivery with its total time, retries and rate limit waits included"""
+    result["elapsed"] = time.monotonic() - start
+    return result
+
+
+def get_webhook_attempts():
+    """POSTs made per payload and webhook: the first one plus rate-limited retries"""
+    return state.config.get("webhook_max_retries", 3) + 1
+
 
+def post_webhook(url, body):
+    """POST a serialized payload to one webhook and report the outcome and timing"""
+    start = time.monotonic()
+    result = new_webhook_result(url)
+    for attempt in range(get_webhook_attempts()):
+        webhook_rate_limiter.acquire(url)
+        try:
+            response = get_http_session().post(url, data=body, headers=JSON_HEADERS, timeout=get_http_timeout())
+        except Exception as e:
+            record_webhook_error(result, e)
+            break
+        if not record_webhook_response(result, response):
+            break
+    return finish_webhook_result(result, start)
 
-def check_and_notify():
-    """Check for new codes and send notifications"""
-    global sent_codes
+
+def post_to_webhooks(jobs):
+    """POST each (url, payload) job at once with a bounded concurrency, returning results in job order"""
+    if not jobs:
+        return []
     
-    print(f"[{datetime.now()}] Checking for new codes...")
+    jobs = encode_payloads(jobs)
+    pipeline = get_async_pipeline()
+    if pipeline:
+        return pipeline.submit(pipeline.post_webhooks(jobs)).result()
     
-    for game_key in GAMES_DATA:
-        # Check if any webhook has this game enabled
-        webhook_urls = get_webhooks_for_game(game_key)
-        if not webhook_urls:
-            continue
+    workers = max(1, min(state.config.get("delivery_workers", 8), len(jobs)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="deliver") as executor:
+        return list(executor.map(lambda job: post_webhook(*job), jobs))
+
+
+def deliver_to_webhooks(webhook_urls, payload):
+    """Send a payload to many webhooks at once with a bounded number of workers"""
+    return post_to_webhooks([(url, payload) for url in webhook_urls])
+
+
+class AsyncPipeline:
+    """asyncio engine for code fetching and webhook fan-out.
+
+    Runs its own event loop in a background thread next to the Flask app, so hundreds of
+    webhook sends are coroutines sharing one httpx connection pool instead of threads.
+    Work is handed in from synchronous code with submit(), which returns a
+    concurrent.futures.Future.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        threading.Thread(target=self.loop.run_forever, name="async-pipeline", daemon=True).start()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the pipeline's loop from any thread"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def get_client(self):
+        """Shared keep-alive HTTP client, created on the pipeline's loop"""
+        if self.client is None:
+            pool_size = max(state.config.get("http_pool_maxsize", 32), state.config.get("delivery_workers", 8))
+            self.client = httpx.AsyncClient(
+                headers={"User-Agent": "HoyoLabCodeNotifier/1.0"},
+                timeout=get_http_timeout(),
+                limits=httpx.Limits(max_connections=pool_size * 4, max_keepalive_connections=pool_size),
+                transport=httpx.AsyncHTTPTransport(retries=state.config.get("http_retries", 2))
+            )
+        return self.client
+
+    async def fetch_codes(self, game_key, source):
+        """Async counterpart of fetch_codes(): only the request differs"""
+        start = time.monotonic()
+        try:
+            response = await self.get_client().get(source["url"], headers=get_fetch_headers((game_key, source["name"])))
+        except Exception as e:
+            return finish_fetch(game_key, source, start, error=e)
+        return finish_fetch(game_key, source, start, response)
+
+    async def post_webhook(self, url, body):
+        """Async counterpart of post_webhook(): only the rate limit wait and the request differ"""
+        start = time.monotonic()
+        result = new_webhook_result(url)
+        for attempt in range(get_webhook_attempts()):
+            await webhook_rate_limiter.acquire_async(url)
+            try:
+                response = await self.get_client().post(url, content=body, headers=JSON_HEADERS)
+            except Exception as e:
+                record_webhook_error(result, e)
+                break
+            if not record_webhook_response(result, response):
+                break
+        return finish_webhook_result(result, start)
+
+    async def post_webhooks(self, jobs):
+        """POST all (url, body) jobs concurrently, at most delivery_workers at a time"""
+        semaphore = asyncio.Semaphore(max(1, state.config.get("delivery_workers", 8)))
         
-        codes = fetch_codes(game_key)
-        game_sent = sent_codes.get(game_key, [])
+        async def bounded(url, body):
+            async with semaphore:
+                return await self.post_webhook(url, body)
         
-        for code_data in codes:
-            code = code_data.get("code", "").upper()
+        return await asyncio.gather(*(bounded(url, body) for url, body in jobs))
+
+
+def get_async_pipeline():
+    """The asyncio pipeline when pipeline_engine is "asyncio", else None (thread pools are used)"""
+    global async_pipeline
+    
+    if state.config.get("pipeline_engine", "threads") != "asyncio":
+        return None
+    if httpx is None:
+        if async_pipeline is None:
+            print("pipeline_engine is asyncio but httpx is not installed, using threads")
+            async_pipeline = False
+        return None
+    with async_pipeline_lock:
+        if not async_pipeline:
+            async_pipeline = AsyncPipeline()
+        return async_pipeline
+
+
+def get_retry_delay(attempts):
+    """Exponential backoff with jitter for the next delivery attempt"""
+    base = state.config.get("delivery_retry_base", 30)
+    delay = min(state.config.get("delivery_retry_max", 3600), base * (2 ** max(0, attempts - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def enqueue_deliveries(deliveries):
+    """Add persistent deliveries ({url, payload, game, code}) to the queue and return the new entries"""
+    now = time.time()
+    payload_ids = {}  # id(payload) -> payload_id, deliveries sharing a payload object share its stored copy
+    entries = []
+    for delivery in deliveries:
+        payload = delivery["payload"]
+        if id(payload) not in payload_ids:
+            payload_ids[id(payload)] = uuid.uuid4().hex
+        entries.append({
+            "id": uuid.uuid4().hex,
+            **{key: value for key, value in delivery.items() if key != "payload"},
+            "payload_id": payload_ids[id(payload)],
+            "attempts": 0,
+            "created": now,
+            "next_attempt": now,
+            "last_error": None
+        })
+    
+    with locked_delivery_queue():
+        for delivery in deliveries:
+            delivery_queue["payloads"][payload_ids[id(delivery["payload"])]] = delivery["payload"]
+        delivery_queue["pending"].extend(entries)
+        deliveries_in_flight.update(entry["id"] for entry in entries)
+        save_delivery_queue()
+    return entries
+
+
+def run_deliveries(entries):
+    """Send queued deliveries in parallel, then remove, reschedule or dead-letter each one"""
+    if not entries:
+        return []
+    
+    with delivery_queue_lock:
+        jobs = [(entry["url"], delivery_queue["payloads"][entry["payload_id"]]) for entry in entries]
+    results = post_to_webhooks(jobs)
+    
+    max_attempts = state.config.get("delivery_max_attempts", 6)
+    with locked_delivery_queue():
+        finished = set()
+        for entry, result in zip(entries, results):
+            destination = describe_webhook(entry["url"])
+            label = f"{destination} ({entry['game']} {entry['code']})"
+            entry["attempts"] += 1
+            metrics.observe("hoyolab_webhook_delivery_duration_seconds", result["elapsed"], webhook=destination)
+            metrics.inc("hoyolab_webhook_deliveries_total", webhook=destination,
+                        result="success" if result["success"] else "failed")
+            if result["rate_limited"]:
+                metrics.inc("hoyolab_webhook_rate_limited_total", result["rate_limited"], webhook=destination)
             
-            if code and code not in game_sent:
-                print(f"New code found for {game_key}: {code}")
+            if result["success"]:
+                finished.add(entry["id"])
+                print(f"Notification sent to {label} in {result['elapsed']:.2f}s")
+            elif entry["attempts"] >= max_attempts or result["status"] in [401, 404]:
+                # Out of attempts, or the webhook was deleted: retrying cannot help
+                finished.add(entry["id"])
+                entry["last_error"] = result["error"]
+                entry["dead_at"] = time.time()
+                delivery_queue["dead_letter"].append(entry)
+                print(f"Giving up on {label} after {entry['attempts']} attempt(s): {result['error']}")
+            else:
+                entry["last_error"] = result["error"]
+                entry["next_attempt"] = time.time() + get_retry_delay(entry["attempts"])
+                print(f"Failed to send to {label}: {result['error']}, retry {entry['attempts']}/{max_attempts - 1} "
+                      f"in {entry['next_attempt'] - time.time():.0f}s")
+        
+        delivery_queue["pending"] = [e for e in delivery_queue["pending"] if e["id"] not in finished]
+        deliveries_in_flight.difference_update(entry["id"] for entry in entries)
+        prune_dead_letters()
+        save_delivery_queue()
+    
+    record_webhook_statuses({entry["url"]: result["status"] for entry, result in zip(entries, results)})
+    return results
+
+
+def prune_dead_letters():
+    """Drop dead-lettered deliveries past dead_letter_days, then the oldest beyond dead_letter_max"""
+    cutoff = time.time() - state.config.get("dead_letter_days", 7) * 86400
+    with delivery_queue_lock:
+        dead = [entry for entry in delivery_queue["dead_letter"] if entry.get("dead_at", 0) >= cutoff]
+        limit = max(0, state.config.get("dead_letter_max", 500))
+        delivery_queue["dead_letter"] = dead[-limit:] if limit else []
+
+
+def process_delivery_queue():
+    """Retry queued deliveries whose backoff has elapsed"""
+    configured = state.routes.by_url
+    now = time.time()
+    
+    with locked_delivery_queue():
+        # Webhooks removed from the config or disabled no longer get deliveries
+        before = len(delivery_queue["pending"])
+        delivery_queue["pending"] = [e for e in delivery_queue["pending"]
+                                     if e["url"] in configured and configured[e["url"]].get("enabled", True)]
+        dropped = before - len(delivery_queue["pending"])
+        
+        due = [e for e in delivery_queue["pending"]
+               if e["next_attempt"] <= now and e["id"] not in deliveries_in_flight]
+        deliveries_in_flight.update(entry["id"] for entry in due)
+        if dropped:
+            save_delivery_queue()
+    
+    if due:
+        print(f"Retrying {len(due)} queued webhook deliveries")
+    run_deliveries(due)
+
+
+def get_next_delivery_time():
+    """Wall-clock time of the earliest pending retry, or None if the queue is empty"""
+    with delivery_queue_lock:
+        times = [e["next_attempt"] for e in delivery_queue["pending"] if e["id"] not in deliveries_in_flight]
+    return min(times) if times else None
+
+
+def record_webhook_statuses(statuses):
+    """Count consecutive 404s per webhook URL and disable webhooks deleted on Discord; returns their names"""
+    by_url = state.routes.by_url
+    changed = [url for url, status in statuses.items() if url in by_url and (
+        status == 404 or (status in [200, 204] and by_url[url].get("not_found")))]
+    if not changed:
+        return []
+    
+    threshold = state.config.get("webhook_disable_after", 3)
+    disabled = []
+    
+    def apply(new_config):
+        disabled.clear()
+        for webhook in new_config.get("webhooks", []):
+            status = statuses.get(webhook.get("url")) if isinstance(webhook, dict) else None
+            if status in [200, 204]:
+                webhook.pop("not_found", None)
+            elif status == 404:
+                webhook["not_found"] = webhook.get("not_found", 0) + 1
+                if threshold and webhook["not_found"] >= threshold and webhook.get("enabled", True):
+                    webhook["enabled"] = False
+                    webhook["disabled_reason"] = f"Discord returned 404 {webhook['not_found']} times in a row"
+                    disabled.append(webhook.get("name", ""))
+    
+    state.update_config(apply)
+    for name in disabled:
+        print(f"Disabled webhook {name}: deleted on Discord")
+    return disabled
+
+
+def make_pacer(rate):
+    """Function that blocks its callers so that together they make at most rate calls per second"""
+    lock = threading.Lock()
+    next_time = [time.monotonic()]
+    
+    def pace():
+        with lock:
+            now = time.monotonic()
+            slot = max(now, next_time[0])
+            next_time[0] = slot + 1 / rate
+        if slot > now:
+            time.sleep(slot - now)
+    return pace
+
+
+def check_webhook(url, pace):
+    """Look a webhook up on Discord (GET on its URL) and report whether it still exists"""
+    result = {"url": url, "status": None, "valid": False, "error": None}
+    for attempt in range(2):
+        pace()
+        try:
+            response = get_http_session().get(url, timeout=get_http_timeout())
+        except Exception as e:
+            result["error"] = str(e)
+            return result
+        result["status"] = response.status_code
+        if response.status_code != 429 or attempt:
+            break
+        try:
+            retry_after = float(response.headers.get("Retry-After", 1))
+        except ValueError:
+            retry_after = 1
+        time.sleep(min(retry_after, 10))
+    
+    result["valid"] = result["status"] == 200
+    if result["status"] == 404:
+        result["error"] = "Webhook deleted on Discord"
+    elif not result["valid"]:
+        result["error"] = f"Webhook returned {result['status']}"
+    return result
+
+
+def validate_webhooks(urls):
+    """Check webhook URLs against Discord concurrently, at most webhook_validation_rate lookups per second"""
+    if not urls:
+        return [], []
+    pace = make_pacer(max(0.1, float(state.config.get("webhook_validation_rate", 5))))
+    workers = max(1, min(state.config.get("delivery_workers", 8), len(urls)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="validate") as executor:
+        results = list(executor.map(lambda url: check_webhook(url, pace), urls))
+    disabled = record_webhook_statuses({result["url"]: result["status"] for result in results})
+    return results, disabled
+
+
+def build_webhook(data):
+    """Webhook config entry from API or import data, or raise ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError("Webhook must be an object")
+    url = str(data.get("url") or "").strip()
+    if not url:
+        raise ValueError("Webhook URL is required")
+    games = data.get("games", {"genshin": True, "starrail": True, "zenless": True})
+    if not isinstance(games, dict):
+        raise ValueError("games must be an object")
+    if data.get("template"):
+        compile_template(data["template"])
+    validate_webhook_rules(data)
+    
+    webhook = {
+        "name": str(data.get("name") or "Webhook").strip(),
+        "url": url,
+        "games": games,
+        "batch_codes": bool(data.get("batch_codes", True)),
+        "reminders": bool(data.get("reminders", True))
+    }
+    if not data.get("enabled", True):
+        webhook["enabled"] = False
+    for field in ["template", "filters", "rules"]:
+        if data.get(field):
+            webhook[field] = data[field]
+    return webhook
+
+
+def parse_webhooks_csv(text):
+    """Webhook entries from CSV with a header row, see WEBHOOK_CSV_FIELDS"""
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames or "url" not in reader.fieldnames:
+        raise ValueError("CSV needs a header row with a url column")
+    entries = []
+    for row in reader:
+        entry = {"name": row.get("name") or "Webhook", "url": row.get("url") or ""}
+        if row.get("games"):
+            entry["games"] = {game: True for game in re.split(r"[;,|\s]+", row["games"]) if game}
+        for field in ["batch_codes", "reminders", "enabled"]:
+            if row.get(field):
+                entry[field] = row[field].strip().lower() in ["1", "true", "yes"]
+        for field in ["template", "filters", "rules"]:
+            if row.get(field):
+                try:
+                    entry[field] = json.loads(row[field])
+                except ValueError:
+                    raise ValueError(f"Line {reader.line_num}: {field} is not valid JSON")
+        entries.append(entry)
+    return entries
+
+
+def format_webhooks_csv(webhooks):
+    """CSV export of webhooks, readable by parse_webhooks_csv()"""
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=WEBHOOK_CSV_FIELDS)
+    writer.writeheader()
+    for webhook in webhooks:
+        if not isinstance(webhook, dict):
+            continue
+        row = {
+            "name": webhook.get("name", ""),
+            "url": webhook.get("url", ""),
+            "games": ";".join(game for game, enabled in (webhook.get("games") or {}).items() if enabled),
+            "batch_codes": str(bool(webhook.get("batch_codes", True))).lower(),
+            "reminders": str(bool(webhook.get("reminders", True))).lower(),
+            "enabled": str(bool(webhook.get("enabled", True))).lower()
+        }
+        for field in ["template", "filters", "rules"]:
+            row[field] = json.dumps(webhook[field]) if webhook.get(field) else ""
+        writer.writerow(row)
+    return output.getvalue()
+
+
+def get_webhooks_for_game(game_key):
+    """Get all webhook URLs that have this game enabled"""
+    return state.routes.urls_for_game(game_key)
+
+
+def get_game_color(game_key):
+    """Get embed color for each game"""
+    return GAME_COLORS.get(game_key, 0x7289DA)
+
+
+@timed("hoyolab_check_duration_seconds")
+def check_and_notify(game_keys=None):
+    """Check for new codes and send notifications, for the given games or all of them"""
+    global last_check_time
+    
+    reload_config_if_changed()
+    # Codes cleared, archived or imported by another worker: cleared codes count as new again,
+    # so the cached payload validators must go too or those codes would never be diffed
+    if code_store.has_changed():
+        load_sent_codes()
+        fetch_validators.clear()
+    now = datetime.now()
+    last_check_time = now.isoformat()
+    print(f"[{now}] Checking for new codes{'' if game_keys is None else ' (' + ', '.join(game_keys) + ')'}...")
+    
+    process_delivery_queue()
+    
+    # Only fetch games that at least one webhook has enabled
+    game_keys = [game_key for game_key in (game_keys or GAMES_DATA) if get_webhooks_for_game(game_key)]
+    
+    # Sources race: a code is sent from whichever source reports it first, later reports are duplicates.
+    # New codes are held for batch_window seconds so codes dropping together share messages
+    outcomes = {}
+    batch = {}  # (game_key, code) -> (code_data, source name)
+    # Validators of fetched payloads are only committed once their new codes have been handled
+    pending_validators = {}  # (game_key, source name) -> (validators, codes of the payload in the batch)
+    batch_started = None
+    batch_window = state.config.get("batch_window", 2)
+    for result in fetch_all_codes(game_keys, lambda: batch_started + batch_window if batch else None):
+        if result is None:
+            # batch_window ran out while slower sources are still being fetched: don't wait for them
+            flush_code_batch(batch, pending_validators, outcomes)
+            batch_started = None
+            continue
+        game_key, source, codes, validators = result
+        outcome = outcomes.setdefault(game_key, {"changed": False, "found_new": False, "fetched": False})
+        if codes is FETCH_FAILED:
+            continue
+        outcome["fetched"] = True
+        batched = set()
+        if codes is not None:
+            outcome["changed"] = True
+            unsent = 0
+            for code_data in codes:
+                code = code_data["code"]
+                if (game_key, code) in batch:
+                    batched.add((game_key, code))
+                    continue
+                if state.is_code_sent(game_key, code):
+                    code_sightings.pop((game_key, code), None)
+                    continue
+                unsent += 1
+                code_first_seen.setdefault((game_key, code), time.monotonic())
                 
-                if send_discord_notification(game_key, code_data):
-                    if game_key not in sent_codes:
-                        sent_codes[game_key] = []
-                    sent_codes[game_key].append(code)
-                    save_sent_codes()
+                if not source.get("trusted", True):
+                    # Hold codes from untrusted sources until enough sources agree on them
+                    seen = code_sightings.setdefault((game_key, code), set())
+                    seen.add(source["name"])
+                    if len(seen) < state.config.get("source_min_confirmations", 2):
+                        continue
                 
-                # Rate limit: wait between notifications
-                time.sleep(2)
+                print(f"New code found for {game_key} by {source['name']}: {code}")
+                batch[(game_key, code)] = (code_data, source["name"])
+                batched.add((game_key, code))
+                batch_started = batch_started or time.monotonic()
+            metrics.observe("hoyolab_fetch_new_codes", unsent, game=game_key, source=source["name"])
+        if validators is not None:
+            if batched:
+                pending_validators[(game_key, source["name"])] = (validators, batched)
+            else:
+                fetch_validators[(game_key, source["name"])] = validators
+        
+        if batch and time.monotonic() - batch_started >= batch_window:
+            flush_code_batch(batch, pending_validators, outcomes)
+            batch_started = None
+    
+    flush_code_batch(batch, pending_validators, outcomes)
+    
+    for game_key, outcome in outcomes.items():
+        update_game_schedule(game_key, **outcome)
+
+
+def flush_code_batch(batch, pending_validators, outcomes):
+    """Send the batched new codes, record the ones that were handled and commit their payloads' validators"""
+    if not batch:
+        return
+    
+    queued, filtered = send_code_notifications(
+        [(game_key, code_data) for (game_key, _), (code_data, _) in batch.items()]
+    )
+    # Codes every webhook filtered out are handled too: recorded like sent ones so they are not
+    # found again on every poll, but they do not count as a code drop for the poll schedule
+    for game_key, code_data in queued + filtered:
+        code = code_data["code"]
+        expiration_date = parse_expiration_date(code_data)
+        record_sent_code(game_key, code, expiration_date.isoformat() if expiration_date else None)
+        record_first_report(batch[(game_key, code)][1])
+        code_sightings.pop((game_key, code), None)
+        code_first_seen.pop((game_key, code), None)
+    for game_key, _ in queued:
+        outcomes[game_key]["found_new"] = True
+    remember_reminder_codes(queued, filtered)
+    
+    # Payloads with unhandled codes keep their old validators, so the next check diffs them again
+    handled = {(game_key, code_data["code"]) for game_key, code_data in queued + filtered}
+    for fetch_key, (validators, codes) in pending_validators.items():
+        if codes <= handled:
+            fetch_validators[fetch_key] = validators
+    pending_validators.clear()
+    batch.clear()
+
+
+def run_check(game_keys=None):
+    """Run check_and_notify unless a check is already in flight; returns False if it was merged into that one"""
+    if not check_lock.acquire(blocking=False):
+        return False
+    try:
+        check_and_notify(game_keys)
+    finally:
+        check_lock.release()
+    return True
+
+
+def validate_fast_windows(windows):
+    """Raise ValueError for fast windows in_fast_window() cannot evaluate"""
+    if not isinstance(windows, list):
+        raise ValueError("fast_windows must be a list")
+    for window in windows:
+        if not isinstance(window, dict):
+            raise ValueError("Each fast window must be an object")
+        for field in ["start", "end"]:
+            if field in window:
+                clock = window[field]
+                if not isinstance(clock, str) or not re.fullmatch(r"([01]\d|2[0-3]):[0-5]\d|24:00", clock):
+                    raise ValueError(f"Fast window {field} must be a HH:MM time")
+        weekday = window.get("weekday")
+        if "weekday" in window and (isinstance(weekday, bool) or weekday not in range(7)):
+            raise ValueError("Fast window weekday must be 0 (Monday) to 6 (Sunday)")
+        if window.get("date") is not None:
+            try:
+                datetime.strptime(str(window["date"]), "%Y-%m-%d")
+            except ValueError:
+                raise ValueError("Fast window date must be YYYY-MM-DD")
+        games = window.get("games")
+        if games is not None and (not isinstance(games, list) or not all(game in GAMES_DATA for game in games)):
+            raise ValueError(f"Fast window games must be a list of: {', '.join(GAMES_DATA)}")
+
+
+def in_fast_window(game_key, now):
+    """Whether a configured fast window (livestream, patch day...) covers this game at this time"""
+    local_now = now.astimezone(get_user_timezone())
+    clock = local_now.strftime("%H:%M")
+    for window in state.config.get("fast_windows", []):
+        if window.get("games") and game_key not in window["games"]:
+            continue
+        if "weekday" in window and window["weekday"] != local_now.weekday():
+            continue
+        if window.get("date") and window["date"] != local_now.strftime("%Y-%m-%d"):
+            continue
+        if window.get("start", "00:00") <= clock < window.get("end", "24:00"):
+            return True
+    return False
+
+
+def get_poll_interval(game_key):
+    """Seconds until a game should be polled again"""
+    base = state.config.get("check_interval", 300)
+    if not state.config.get("adaptive_polling", True):
+        return base
+    
+    schedule = game_schedule.get(game_key, {})
+    now = time.time()
+    recent_drop = now - schedule.get("last_new_code", 0) < state.config.get("burst_duration", 7200)
+    if recent_drop or in_fast_window(game_key, datetime.now(pytz.UTC)):
+        return min(base, state.config.get("fast_check_interval", 60))
+    return schedule.get("quiet_interval", base)
+
+
+def update_game_schedule(game_key, changed, found_new, fetched=True):
+    """Adapt a game's polling interval to what the last poll saw and schedule its next poll.
+
+    If every source failed (fetched is False) the poll saw nothing, and the interval is left as it was.
+    """
+    base = state.config.get("check_interval", 300)
+    schedule = game_schedule.setdefault(game_key, {"quiet_interval": base, "last_new_code": 0})
+    
+    if found_new:
+        schedule["last_new_code"] = time.time()
+        schedule["quiet_interval"] = base
+    elif changed:
+        schedule["quiet_interval"] = base
+    elif fetched:
+        # Nothing happening: back off so faster polling elsewhere does not raise the total request volume
+        schedule["quiet_interval"] = min(
+            max(base, state.config.get("max_check_interval", 1800)),
+            max(base, schedule["quiet_interval"] * 1.5)
+        )
+    schedule["next_poll"] = time.time() + get_poll_interval(game_key)
+
+
+def request_check(game_keys=None):
+    """Ask the checker thread to poll these games (or all) right away"""
+    with check_requests_lock:
+        check_requests.update(game_keys or GAMES_DATA)
+    wake_checker.set()
+
+
+def get_due_games():
+    """Games whose next poll is due or that were explicitly requested, and clear the requests"""
+    now = time.time()
+    with check_requests_lock:
+        due = set(check_requests)
+        check_requests.clear()
+    for game_key in GAMES_DATA:
+        if game_schedule.get(game_key, {}).get("next_poll", 0) <= now:
+            due.add(game_key)
+    return [game_key for game_key in GAMES_DATA if game_key in due]
 
 
 def checker_loop():
-    """Background thread for periodic code checking"""
+    """Background thread polling each game on its own schedule"""
     while not stop_checker.is_set():
+        due = get_due_games()
         try:
-            check_and_notify()
+            if due:
+                run_check(due)
+                compact_storage_if_due()
+            else:
+                process_delivery_queue()
+            send_expiration_reminders()
         except Exception as e:
             print(f"Error in checker loop: {e}")
         
-        interval = config.get("check_interval", 300)
-        stop_checker.wait(interval)
+        # Games without enabled webhooks are not polled; look at them again after check_interval
+        for game_key in due:
+            schedule = game_schedule.setdefault(game_key, {})
+            if schedule.get("next_poll", 0) <= time.time():
+                schedule["next_poll"] = time.time() + state.config.get("check_interval", 300)
+        
+        # Sleep until the next game poll or queued delivery retry falls due
+        next_poll = min(schedule.get("next_poll", 0) for schedule in game_schedule.values()) if game_schedule \
+            else time.time() + state.config.get("check_interval", 300)
+        wake_at = min(next_poll, get_next_delivery_time() or next_poll,
+                      state.expiration_index.next_reminder_time() or next_poll)
+        if wake_checker.wait(max(0, wake_at - time.time())):
+            # Stop requested, or a check was requested by a route or another worker
+            wake_checker.clear()
 
 
 def start_checker():
@@ -458,12 +3166,179 @@ def start_checker():
     global checker_thread, stop_checker
     
     stop_checker.clear()
+    wake_checker.clear()
+    load_reminder_codes()
     checker_thread = threading.Thread(target=checker_loop, daemon=True)
     checker_thread.start()
+    # Statistics events a previous leader did not get to send
+    load_stats_outbox()
+    if stats_outbox:
+        start_stats_reporter()
     print("Code checker started")
 
 
+def stop_checker_thread():
+    """Ask the background checker thread to stop after its current check"""
+    stop_checker.set()
+    wake_checker.set()
+    stats_wake.set()
+    print("Code checker stopped")
+
+
+class FileLeaderLock:
+    """Leader lock held through an exclusive flock() on a file.
+
+    Covers all workers on one host, and hosts sharing a volume with working flock().
+    The lock is released by the OS if the process dies.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self):
+        """Take the lock if free; returns whether this process holds it"""
+        if self.fd is not None:
+            return True
+        if fcntl is None:
+            return True  # No flock() on this platform: assume a single process
+        
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+
+class SqliteLeaseLock:
+    """Leader lease stored in a SQLite database with an expiry, renewed by the holder.
+
+    Works wherever the database can be shared; a crashed leader is replaced once its
+    lease runs out after LEADER_LEASE_TTL seconds.
+    """
+
+    def __init__(self, path):
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def acquire(self):
+        """Take or renew the lease; returns whether this process holds it"""
+        now = time.time()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT holder, expires_at FROM leases WHERE name = 'checker'").fetchone()
+            if row is None or row[0] == self.holder or row[1] < now:
+                self.conn.execute(
+                    "INSERT INTO leases (name, holder, expires_at) VALUES ('checker', ?, ?) "
+                    "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at",
+                    (self.holder, now + LEADER_LEASE_TTL)
+                )
+                self.conn.execute("COMMIT")
+                return True
+            self.conn.execute("COMMIT")
+            return False
+        except sqlite3.Error as e:
+            print(f"Error renewing checker lease: {e}")
+            try:
+                self.conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            return False
+
+
+class NoLeaderLock:
+    """Every process is the leader (single worker deployments)"""
+
+    def acquire(self):
+        return True
+
+
+def create_leader_lock():
+    """Create the leader lock backend selected by LEADER_LOCK"""
+    ensure_data_dir()
+    data_dir = os.path.dirname(CODES_PATH)
+    if LEADER_LOCK == "sqlite":
+        return SqliteLeaseLock(LEADER_LOCK_PATH or os.path.join(data_dir, 'checker_lease.db'))
+    if LEADER_LOCK == "none":
+        return NoLeaderLock()
+    return FileLeaderLock(LEADER_LOCK_PATH or os.path.join(data_dir, 'checker.lock'))
+
+
+def is_checker_running():
+    """Whether this process, or another worker holding the leader lock, is running the checker"""
+    if checker_thread is not None and checker_thread.is_alive():
+        return True
+    heartbeat = file_stamp(CHECKER_HEARTBEAT_PATH)
+    return heartbeat is not None and time.time() - heartbeat[0] / 1e9 < LEADER_RENEW_INTERVAL * 3
+
+
+def leadership_loop():
+    """Run the checker in this process only while it holds the leader lock"""
+    while True:
+        try:
+            is_leader = leader_lock.acquire()
+        except Exception as e:
+            print(f"Error acquiring checker leadership: {e}")
+            is_leader = False
+        alive = checker_thread is not None and checker_thread.is_alive()
+        
+        if is_leader and not alive:
+            print(f"Checker leadership acquired by process {os.getpid()}")
+            start_checker()
+        elif is_leader and stop_checker.is_set():
+            # Leadership regained while the old checker thread was still winding down
+            stop_checker.clear()
+        elif not is_leader and alive and not stop_checker.is_set():
+            print(f"Checker leadership lost by process {os.getpid()}")
+            stop_checker_thread()
+        
+        if is_leader:
+            # Heartbeat for /api/status in other workers, and checks requested through them
+            try:
+                # Check times only exist in this process too: /api/status in the other workers reads them from here
+                write_json_atomic(CHECKER_HEARTBEAT_PATH, {"pid": os.getpid(), **get_local_check_progress()}, indent=None)
+                # Fetch and delivery metrics only exist in this process: share them with the other workers
+                with open(f"{METRICS_SNAPSHOT_PATH}.tmp", 'w') as f:
+                    f.write(metrics.render())
+                os.replace(f"{METRICS_SNAPSHOT_PATH}.tmp", METRICS_SNAPSHOT_PATH)
+                if os.path.exists(CHECK_TRIGGER_PATH):
+                    # Claim the requests atomically so ones written meanwhile land in a new file
+                    claimed = f"{CHECK_TRIGGER_PATH}.{os.getpid()}"
+                    os.replace(CHECK_TRIGGER_PATH, claimed)
+                    with open(claimed, 'r') as f:
+                        requested = [line.strip() for line in f if line.strip() in GAMES_DATA]
+                    os.remove(claimed)
+                    request_check(requested or None)
+            except OSError as e:
+                print(f"Error updating checker heartbeat: {e}")
+        
+        time.sleep(LEADER_RENEW_INTERVAL)
+
+
+def start_coordinator():
+    """Compete for the leader lock in the background, unless this process is web-only"""
+    global leader_lock
+    
+    if RUN_CHECKER in ("false", "0", "no"):
+        print("Checker disabled in this process (RUN_CHECKER=false)")
+        return
+    leader_lock = create_leader_lock()
+    threading.Thread(target=leadership_loop, daemon=True).start()
+
+
 # Flask Routes
+@app.before_request
+def sync_shared_state():
+    """Other workers may have changed the config since the last request"""
+    reload_config_if_changed()
+
+
 @app.route('/')
 def index():
     """Main page"""
@@ -481,89 +3356,338 @@ def get_config():
         }
     
     return jsonify({
-        "webhooks": config.get("webhooks", []),
-        "check_interval": config.get("check_interval", 300),
-        "timezone": config.get("timezone", "UTC"),
+        "webhooks": state.config.get("webhooks", []),
+        "check_interval": state.config.get("check_interval", 300),
+        "timezone": state.config.get("timezone", "UTC"),
+        "fetch_deadline": state.config.get("fetch_deadline", 20),
+        "adaptive_polling": state.config.get("adaptive_polling", True),
+        "fast_check_interval": state.config.get("fast_check_interval", 60),
+        "max_check_interval": state.config.get("max_check_interval", 1800),
+        "fast_windows": state.config.get("fast_windows", []),
+        "sources": state.config.get("sources", []),
+        "source_min_confirmations": state.config.get("source_min_confirmations", 2),
+        "batch_window": state.config.get("batch_window", 2),
+        "expiration_reminders": state.config.get("expiration_reminders", [24, 1]),
+        "retention_days": state.config.get("retention_days", 30),
+        "max_hot_codes": state.config.get("max_hot_codes", 1000),
         "games_info": games_info
     })
 
 
+def parse_config_number(data, name, minimum, cast=int):
+    """data[name] as a number of at least minimum; ValueError if it is not a number"""
+    value = data[name]
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{name} must be a number")
+    try:
+        return max(minimum, cast(value))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{name} must be a number")
+
+
 @app.route('/api/config', methods=['POST'])
 def update_config():
     """Update configuration"""
-    global config
-    
     data = request.json
     
-    if "check_interval" in data:
-        config["check_interval"] = max(60, int(data["check_interval"]))
-    
-    if "timezone" in data:
-        # Validate timezone
-        try:
-            pytz.timezone(data["timezone"])
-            config["timezone"] = data["timezone"]
-        except:
-            pass  # Keep existing timezone if invalid
-    
-    if "webhooks" in data:
-        config["webhooks"] = data["webhooks"]
-    
-    save_config()
+    def apply(new_config):
+        if "check_interval" in data:
+            new_config["check_interval"] = parse_config_number(data, "check_interval", 60)
+        
+        if "fetch_deadline" in data:
+            new_config["fetch_deadline"] = parse_config_number(data, "fetch_deadline", 5)
+        
+        if "adaptive_polling" in data:
+            new_config["adaptive_polling"] = bool(data["adaptive_polling"])
+        
+        if "fast_check_interval" in data:
+            new_config["fast_check_interval"] = parse_config_number(data, "fast_check_interval", 30)
+        
+        if "max_check_interval" in data:
+            new_config["max_check_interval"] = parse_config_number(data, "max_check_interval", 60)
+        
+        if "fast_windows" in data:
+            validate_fast_windows(data["fast_windows"])
+            new_config["fast_windows"] = data["fast_windows"]
+        
+        if "sources" in data:
+            validate_sources(data["sources"])
+            new_config["sources"] = data["sources"]
+        
+        if "source_min_confirmations" in data:
+            new_config["source_min_confirmations"] = parse_config_number(data, "source_min_confirmations", 1)
+        
+        if "expiration_reminders" in data:
+            reminders = data["expiration_reminders"]
+            if not isinstance(reminders, list) or not all(
+                    isinstance(hours, (int, float)) and hours > 0 for hours in reminders):
+                raise ValueError("expiration_reminders must be a list of positive hours")
+            new_config["expiration_reminders"] = reminders
+        
+        if "retention_days" in data:
+            new_config["retention_days"] = parse_config_number(data, "retention_days", 1)
+        
+        if "max_hot_codes" in data:
+            new_config["max_hot_codes"] = parse_config_number(data, "max_hot_codes", 10)
+        
+        if "batch_window" in data:
+            new_config["batch_window"] = parse_config_number(data, "batch_window", 0, float)
+        
+        if "timezone" in data:
+            # Validate timezone
+            try:
+                pytz.timezone(data["timezone"])
+                new_config["timezone"] = data["timezone"]
+            except:
+                pass  # Keep existing timezone if invalid
+        
+        if "webhooks" in data:
+            if not isinstance(data["webhooks"], list):
+                raise ValueError("webhooks must be a list")
+            for webhook in data["webhooks"]:
+                if isinstance(webhook, dict) and webhook.get("template"):
+                    compile_template(webhook["template"])
+                if isinstance(webhook, dict):
+                    validate_webhook_rules(webhook)
+            new_config["webhooks"] = data["webhooks"]
+    
+    if not isinstance(data, dict):
+        return jsonify({"success": False, "message": "Expected a JSON object"}), 400
+    
+    old_timezone = state.config.get("timezone")
+    try:
+        state.update_config(apply)
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    if state.config.get("timezone") != old_timezone:
+        invalidate_status_cache(timezone_changed=True)
     return jsonify({"success": True, "message": "Configuration saved"})
 
 
 @app.route('/api/status', methods=['GET'])
 def get_status():
     """Get current status"""
-    # Reload sent codes from file to reflect any manual changes
-    load_sent_codes()
+    # Reload sent codes only if the storage was changed outside this process (e.g. manual edits)
+    if code_store.has_changed():
+        load_sent_codes()
+    # The checker may run in another worker: its queued deliveries and check times come from disk
+    reload_delivery_queue_if_changed()
+    progress = get_check_progress()
+    
+    # Codes that expired since the last call drop out of the active list
+    if state.expiration_index.pop_expired():
+        invalidate_status_cache()
+    
+    # Expiration urgency text changes with time, so a cached response is reused for one minute at most
+    checker_running = is_checker_running()
+    cache_key = (
+        state.version, int(time.time() // 60), checker_running, progress["last_check"],
+        tuple(sorted(progress["next_checks"].items())),
+        len(delivery_queue["pending"]), len(delivery_queue["dead_letter"])
+    )
+    
+    if status_cache["key"] != cache_key:
+        body = app.json.dumps(build_status(checker_running, progress)).encode()
+        status_cache.update(key=cache_key, body=body, etag=hashlib.sha1(body).hexdigest())
+    
+    response = app.response_class(status_cache["body"], mimetype="application/json")
+    response.set_etag(status_cache["etag"])
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+def get_local_check_progress():
+    """Last check time and next poll time per game of the checker running in this process"""
+    return {
+        "last_check": last_check_time,
+        "next_checks": {
+            game_key: datetime.fromtimestamp(schedule["next_poll"]).isoformat()
+            for game_key, schedule in game_schedule.items() if schedule.get("next_poll")
+        }
+    }
+
+
+def get_check_progress():
+    """Last check time and next poll times of the checker, which may run in another worker"""
+    if checker_thread is not None and checker_thread.is_alive():
+        return get_local_check_progress()
+    try:
+        with open(CHECKER_HEARTBEAT_PATH, 'r') as f:
+            heartbeat = json.load(f)
+        return {"last_check": heartbeat.get("last_check"), "next_checks": heartbeat.get("next_checks", {})}
+    except (OSError, ValueError, AttributeError):
+        # No checker yet, or a heartbeat written before it carried the check times
+        return {"last_check": last_check_time, "next_checks": {}}
+
+
+def build_status(checker_running, progress):
+    """Build the /api/status document from the in-memory state"""
+    sent_codes, code_expiration = state.codes_snapshot()
     
     # Build codes with expiration info for the UI
     codes_with_expiration = {}
-    user_tz = get_user_timezone()
+    unknown_status = {"status": "unknown", "urgency": "normal", "text": "No expiration info"}
     
     for game_key in GAMES_DATA:
-        game_codes = sent_codes.get(game_key, [])
-        game_exp = code_expiration_data.get(game_key, {})
+        game_exp = code_expiration.get(game_key, {})
         codes_with_expiration[game_key] = []
         
-        for code in game_codes:
+        for code in sent_codes.get(game_key, []):
+            if state.expiration_index.is_expired(game_key, code):
+                continue
             code_info = {"code": code}
-            if code in game_exp:
-                try:
-                    exp_date = date_parser.parse(game_exp[code])
-                    status = get_expiration_status(exp_date)
-                    
-                    # Format expiration time in user's timezone
-                    if exp_date.tzinfo is None:
-                        exp_date = pytz.UTC.localize(exp_date)
-                    local_exp = exp_date.astimezone(user_tz)
-                    formatted_time = local_exp.strftime("%b %d, %Y at %H:%M %Z")
-                    
-                    code_info["expiration"] = game_exp[code]
-                    code_info["expiration_formatted"] = formatted_time
-                    code_info["expiration_status"] = status
-                except:
-                    code_info["expiration_status"] = {"status": "unknown", "urgency": "normal", "text": "No expiration info"}
+            view = get_code_view(game_key, code, game_exp.get(code))
+            if view["date"]:
+                code_info["expiration"] = view["expiration"]
+                code_info["expiration_formatted"] = view["formatted"]
+                code_info["expiration_status"] = get_expiration_status(view["date"])
             else:
-                code_info["expiration_status"] = {"status": "unknown", "urgency": "normal", "text": "No expiration info"}
+                code_info["expiration_status"] = unknown_status
             
             codes_with_expiration[game_key].append(code_info)
     
-    return jsonify({
+    return {
         "sent_codes": sent_codes,
         "codes_with_expiration": codes_with_expiration,
-        "checker_running": checker_thread is not None and checker_thread.is_alive(),
-        "last_check": datetime.now().isoformat()
-    })
+        "checker_running": checker_running,
+        "delivery_queue": {
+            "pending": len(delivery_queue["pending"]),
+            "dead_letter": len(delivery_queue["dead_letter"])
+        },
+        **progress
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus metrics of the checker"""
+    body = metrics.render()
+    if not (checker_thread is not None and checker_thread.is_alive()) and is_checker_running():
+        # Another worker runs the checker: serve its latest snapshot
+        try:
+            with open(METRICS_SNAPSHOT_PATH, 'r') as f:
+                body = f.read()
+        except OSError:
+            pass
+    return app.response_class(body, mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/api/check-now', methods=['POST'])
 def check_now():
     """Manually trigger a code check"""
-    threading.Thread(target=check_and_notify, daemon=True).start()
-    return jsonify({"success": True, "message": "Check triggered"})
+    # Always request it: a check in progress may cover only some games, and requests are
+    # merged into the checker's next wake-up anyway
+    in_progress = check_lock.locked()
+    try:
+        local = dispatch_check_request()
+    except OSError as e:
+        return jsonify({"success": False, "message": f"Could not request a check: {e}"})
+    if in_progress:
+        return jsonify({"success": True, "message": "Check requested, it runs after the one in progress"})
+    return jsonify({"success": True, "message": "Check triggered" if local else "Check requested"})
+
+
+@app.route('/api/trigger', methods=['POST'])
+def push_trigger():
+    """Inbound push (e.g. from a livestream or news webhook): fetch the given games right away"""
+    token = state.config.get("trigger_token")
+    if not token:
+        return jsonify({"success": False, "message": "Push triggers are disabled until trigger_token is set"}), 403
+    if not hmac.compare_digest(request.headers.get("X-Trigger-Token", "").encode(), str(token).encode()):
+        return jsonify({"success": False, "message": "Invalid trigger token"}), 403
+    
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"success": False, "message": "Expected a JSON object"}), 400
+    if "games" in data:
+        game_keys = data["games"]
+        if not isinstance(game_keys, list) or not all(isinstance(game_key, str) for game_key in game_keys):
+            return jsonify({"success": False, "message": "games must be a list of game names"}), 400
+    elif "game" in data:
+        if not isinstance(data["game"], str):
+            return jsonify({"success": False, "message": "game must be a game name"}), 400
+        game_keys = [data["game"]]
+    else:
+        game_keys = list(GAMES_DATA)
+    unknown = [game_key for game_key in game_keys if game_key not in GAMES_DATA]
+    if unknown or not game_keys:
+        return jsonify({"success": False, "message": f"Unknown game(s): {', '.join(unknown) or 'none given'}"}), 400
+    
+    # Each trigger forces upstream fetches: accept at most one per game every trigger_min_interval
+    now = time.time()
+    min_interval = state.config.get("trigger_min_interval", 60)
+    with check_requests_lock:
+        throttled = [game_key for game_key in game_keys if now - last_triggers.get(game_key, 0) < min_interval]
+        game_keys = [game_key for game_key in dict.fromkeys(game_keys) if game_key not in throttled]
+        for game_key in game_keys:
+            last_triggers[game_key] = now
+    if not game_keys:
+        return jsonify({"success": False, "message": f"Triggered too recently: {', '.join(throttled)}"}), 429
+    
+    try:
+        local = dispatch_check_request(game_keys)
+    except OSError as e:
+        return jsonify({"success": False, "message": f"Could not request a check: {e}"})
+    action = "triggered" if local else "requested"
+    message = f"Check {action} for {', '.join(game_keys)}"
+    if throttled:
+        message += f" (triggered too recently: {', '.join(throttled)})"
+    return jsonify({"success": True, "message": message})
+
+
+def dispatch_check_request(game_keys=None):
+    """Wake the checker here if this process runs it, else leave the request for the leader; True if local"""
+    if checker_thread is not None and checker_thread.is_alive():
+        request_check(game_keys)
+        return True
+    
+    # Another worker is the checker leader: append, so requests made before it picks them up add up
+    ensure_data_dir()
+    with open(CHECK_TRIGGER_PATH, 'a') as f:
+        f.write("".join(f"{game_key}\n" for game_key in (game_keys or GAMES_DATA)))
+    return False
+
+
+@app.route('/api/sources', methods=['GET'])
+def list_sources():
+    """Code sources per game, with their latency and reliability scores"""
+    return jsonify({
+        "sources": {game_key: get_sources(game_key) for game_key in GAMES_DATA},
+        "scores": get_source_scores()
+    })
+
+
+@app.route('/api/deliveries', methods=['GET'])
+def get_deliveries():
+    """List queued and dead-lettered webhook deliveries"""
+    fields = ["id", "game", "code", "url", "attempts", "created", "next_attempt", "last_error", "dead_at"]
+    reload_delivery_queue_if_changed()
+    with delivery_queue_lock:
+        return jsonify({
+            queue: [{key: entry.get(key) for key in fields} for entry in delivery_queue[queue]]
+            for queue in ["pending", "dead_letter"]
+        })
+
+
+@app.route('/api/deliveries/retry', methods=['POST'])
+def retry_dead_letters():
+    """Move dead-lettered deliveries back into the queue"""
+    data = request.json or {}
+    ids = data.get("ids")
+    
+    with locked_delivery_queue():
+        retry = [e for e in delivery_queue["dead_letter"] if ids is None or e["id"] in ids]
+        delivery_queue["dead_letter"] = [e for e in delivery_queue["dead_letter"] if e not in retry]
+        for entry in retry:
+            entry["attempts"] = 0
+            entry["next_attempt"] = time.time()
+            entry.pop("dead_at", None)
+        delivery_queue["pending"].extend(retry)
+        save_delivery_queue()
+    
+    if checker_thread is not None and checker_thread.is_alive():
+        threading.Thread(target=process_delivery_queue, daemon=True).start()
+    return jsonify({"success": True, "message": f"{len(retry)} delivery(s) requeued"})
 
 
 @app.route('/api/test-webhook', methods=['POST'])
@@ -577,7 +3701,7 @@ def test_webhook():
         webhook_urls = [webhook_url]
     else:
         # Test all configured webhooks
-        webhooks = config.get("webhooks", [])
+        webhooks = state.config.get("webhooks", [])
         webhook_urls = [w.get("url") for w in webhooks if w.get("url")]
     
     if not webhook_urls:
@@ -594,18 +3718,9 @@ def test_webhook():
         }]
     }
     
-    success_count = 0
-    errors = []
-    
-    for url in webhook_urls:
-        try:
-            response = requests.post(url, json=payload, timeout=10)
-            if response.status_code in [200, 204]:
-                success_count += 1
-            else:
-                errors.append(f"Webhook returned {response.status_code}")
-        except Exception as e:
-            errors.append(str(e))
+    results = deliver_to_webhooks(webhook_urls, payload)
+    success_count = sum(1 for result in results if result["success"])
+    errors = [result["error"] for result in results if not result["success"]]
     
     if success_count > 0:
         msg = f"Test notification sent to {success_count} webhook(s)"
@@ -618,35 +3733,30 @@ def test_webhook():
 
 @app.route('/api/webhooks', methods=['GET'])
 def get_webhooks():
-    """Get all webhooks"""
-    return jsonify({"webhooks": config.get("webhooks", [])})
+    """Get all webhooks, showing the ones whose filters or rules are invalid as disabled"""
+    errors = state.routes.errors
+    return jsonify({"webhooks": [
+        {**webhook, "enabled": False, "disabled_reason": errors[webhook["url"]]}
+        if isinstance(webhook, dict) and webhook.get("url") in errors else webhook
+        for webhook in state.config.get("webhooks", [])
+    ]})
 
 
 @app.route('/api/webhooks', methods=['POST'])
 def add_webhook():
     """Add a new webhook"""
     data = request.json
-    webhook_url = data.get("url", "").strip()
-    webhook_name = data.get("name", "Webhook").strip()
-    games = data.get("games", {"genshin": True, "starrail": True, "zenless": True})
-    
-    if not webhook_url:
-        return jsonify({"success": False, "message": "Webhook URL is required"}), 400
     
-    if "webhooks" not in config:
-        config["webhooks"] = []
+    def apply(new_config):
+        webhook = build_webhook(data)
+        if webhook["url"] in state.routes.by_url:
+            raise ValueError("Webhook already exists")
+        new_config.setdefault("webhooks", []).append(webhook)
     
-    # Check for duplicates
-    for existing in config["webhooks"]:
-        if existing.get("url") == webhook_url:
-            return jsonify({"success": False, "message": "Webhook already exists"}), 400
-    
-    config["webhooks"].append({
-        "name": webhook_name,
-        "url": webhook_url,
-        "games": games
-    })
-    save_config()
+    try:
+        state.update_config(apply)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
     
     return jsonify({"success": True, "message": "Webhook added"})
 
@@ -654,42 +3764,169 @@ def add_webhook():
 @app.route('/api/webhooks/<int:index>', methods=['PUT'])
 def update_webhook(index):
     """Update a webhook"""
-    webhooks = config.get("webhooks", [])
-    
-    if index < 0 or index >= len(webhooks):
-        return jsonify({"success": False, "message": "Invalid webhook index"}), 400
-    
     data = request.json
     
-    if "name" in data:
-        config["webhooks"][index]["name"] = data["name"].strip()
-    if "url" in data:
-        config["webhooks"][index]["url"] = data["url"].strip()
-    if "games" in data:
-        config["webhooks"][index]["games"] = data["games"]
+    def apply(new_config):
+        webhooks = new_config.get("webhooks", [])
+        if index < 0 or index >= len(webhooks):
+            raise ValueError("Invalid webhook index")
+        
+        if "name" in data:
+            webhooks[index]["name"] = data["name"].strip()
+        if "url" in data:
+            url = data["url"].strip()
+            if url != webhooks[index].get("url") and url in state.routes.by_url:
+                raise ValueError("Webhook already exists")
+            webhooks[index]["url"] = url
+        if "games" in data:
+            webhooks[index]["games"] = data["games"]
+        if "batch_codes" in data:
+            webhooks[index]["batch_codes"] = bool(data["batch_codes"])
+        if "reminders" in data:
+            webhooks[index]["reminders"] = bool(data["reminders"])
+        if "enabled" in data:
+            webhooks[index]["enabled"] = bool(data["enabled"])
+            if data["enabled"]:
+                webhooks[index].pop("not_found", None)
+                webhooks[index].pop("disabled_reason", None)
+        if "filters" in data:
+            webhooks[index]["filters"] = data["filters"]
+        if "rules" in data:
+            webhooks[index]["rules"] = data["rules"]
+        if "filters" in data or "rules" in data:
+            validate_webhook_rules(webhooks[index])
+        if "template" in data:
+            compile_template(data["template"])
+            webhooks[index]["template"] = data["template"]
+    
+    try:
+        state.update_config(apply)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
     
-    save_config()
     return jsonify({"success": True, "message": "Webhook updated"})
 
 
 @app.route('/api/webhooks/<int:index>', methods=['DELETE'])
 def remove_webhook(index):
     """Remove a webhook"""
-    webhooks = config.get("webhooks", [])
-    
-    if index < 0 or index >= len(webhooks):
-        return jsonify({"success": False, "message": "Invalid webhook index"}), 400
+    def apply(new_config):
+        webhooks = new_config.get("webhooks", [])
+        if index < 0 or index >= len(webhooks):
+            raise ValueError("Invalid webhook index")
+        webhooks.pop(index)
     
-    config["webhooks"].pop(index)
-    save_config()
+    try:
+        state.update_config(apply)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
     
     return jsonify({"success": True, "message": "Webhook removed"})
 
 
+@app.route('/api/webhooks/export', methods=['GET'])
+def export_webhooks():
+    """Export all webhooks as JSON or CSV (?format=csv)"""
+    webhooks = state.config.get("webhooks", [])
+    if request.args.get("format", "json") == "csv":
+        return app.response_class(
+            format_webhooks_csv(webhooks),
+            mimetype="text/csv",
+            headers={"Content-Disposition": "attachment; filename=webhooks.csv"}
+        )
+    return jsonify({"webhooks": webhooks})
+
+
+@app.route('/api/webhooks/import', methods=['POST'])
+def import_webhooks():
+    """Add or replace many webhooks at once from JSON or CSV; nothing is saved unless every entry is valid"""
+    mode = request.args.get("mode", "merge")
+    try:
+        if request.mimetype == "text/csv":
+            entries = parse_webhooks_csv(request.get_data(as_text=True))
+        else:
+            data = request.get_json(silent=True)
+            if isinstance(data, dict):
+                mode = data.get("mode", mode)
+                data = data.get("webhooks")
+            if not isinstance(data, list):
+                raise ValueError("Expected a list of webhooks")
+            entries = data
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    if mode not in ["merge", "replace"]:
+        return jsonify({"success": False, "message": "mode must be 'merge' or 'replace'"}), 400
+    
+    webhooks = []
+    errors = []
+    seen = set()
+    for position, entry in enumerate(entries, 1):
+        try:
+            webhook = build_webhook(entry)
+            if webhook["url"] in seen:
+                raise ValueError("Duplicate webhook URL")
+        except ValueError as e:
+            errors.append(f"Entry {position}: {e}")
+            continue
+        seen.add(webhook["url"])
+        webhooks.append(webhook)
+    if errors:
+        return jsonify({"success": False, "message": f"No webhooks imported, {len(errors)} invalid entries",
+                        "errors": errors}), 400
+    
+    counts = {"added": 0, "updated": 0}
+    
+    def apply(new_config):
+        if mode == "replace":
+            new_config["webhooks"] = webhooks
+            counts["added"] = len(webhooks)
+            return
+        existing = new_config.setdefault("webhooks", [])
+        positions = {webhook.get("url"): i for i, webhook in enumerate(existing) if isinstance(webhook, dict)}
+        for webhook in webhooks:
+            if webhook["url"] in positions:
+                existing[positions[webhook["url"]]] = webhook
+                counts["updated"] += 1
+            else:
+                existing.append(webhook)
+                counts["added"] += 1
+    
+    # One copy-on-write update: the whole import is published and saved at once, or not at all
+    state.update_config(apply)
+    return jsonify({"success": True, "message": f"{counts['added']} webhook(s) added, {counts['updated']} updated",
+                    **counts})
+
+
+@app.route('/api/webhooks/validate', methods=['POST'])
+def validate_webhooks_route():
+    """Check webhooks against Discord (all, or {"indexes": [...]}) and disable deleted ones"""
+    data = request.get_json(silent=True) or {}
+    webhooks = state.config.get("webhooks", [])
+    indexes = data.get("indexes", range(len(webhooks)))
+    try:
+        selected = [(int(index), webhooks[int(index)]) for index in indexes]
+    except (TypeError, ValueError, IndexError):
+        return jsonify({"success": False, "message": "Invalid webhook index"}), 400
+    selected = [(index, webhook) for index, webhook in selected if isinstance(webhook, dict) and webhook.get("url")]
+    
+    results, disabled = validate_webhooks(list(dict.fromkeys(webhook["url"] for _, webhook in selected)))
+    by_url = {result["url"]: result for result in results}
+    report = [{
+        "index": index,
+        "name": webhook.get("name", ""),
+        **by_url[webhook["url"]]
+    } for index, webhook in selected]
+    valid = sum(1 for result in report if result["valid"])
+    message = f"{valid}/{len(report)} webhooks valid"
+    if disabled:
+        message += f", disabled: {', '.join(disabled)}"
+    return jsonify({"success": True, "message": message, "results": report, "disabled": disabled})
+
+
 @app.route('/api/webhooks/<int:index>/test', methods=['POST'])
 def test_specific_webhook(index):
     """Test a specific webhook"""
-    webhooks = config.get("webhooks", [])
+    webhooks = state.config.get("webhooks", [])
     
     if index < 0 or index >= len(webhooks):
         return jsonify({"success": False, "message": "Invalid webhook index"}), 400
@@ -709,14 +3946,11 @@ def test_specific_webhook(index):
         }]
     }
     
-    try:
-        response = requests.post(webhook_url, json=payload, timeout=10)
-        if response.status_code in [200, 204]:
-            return jsonify({"success": True, "message": "Test notification sent"})
-        else:
-            return jsonify({"success": False, "message": f"Webhook returned {response.status_code}"})
-    except Exception as e:
-        return jsonify({"success": False, "message": str(e)})
+    # Same delivery path as notifications, so the rate limiter sees (and paces) this send too
+    result = deliver_to_webhooks([webhook_url], payload)[0]
+    if result["success"]:
+        return jsonify({"success": True, "message": "Test notification sent"})
+    return jsonify({"success": False, "message": result["error"]})
 
 
 def get_support_payload():
@@ -780,7 +4014,7 @@ def get_support_payload():
 @app.route('/api/webhooks/<int:index>/support', methods=['POST'])
 def send_support_to_webhook(index):
     """Send support notification to a specific webhook"""
-    webhooks = config.get("webhooks", [])
+    webhooks = state.config.get("webhooks", [])
     
     if index < 0 or index >= len(webhooks):
         return jsonify({"success": False, "message": "Invalid webhook index"}), 400
@@ -794,20 +4028,16 @@ def send_support_to_webhook(index):
     
     payload = get_support_payload()
     
-    try:
-        response = requests.post(webhook_url, json=payload, timeout=10)
-        if response.status_code in [200, 204]:
-            return jsonify({"success": True, "message": f"Support notification sent to {webhook_name}"})
-        else:
-            return jsonify({"success": False, "message": f"Webhook returned {response.status_code}"})
-    except Exception as e:
-        return jsonify({"success": False, "message": str(e)})
+    result = deliver_to_webhooks([webhook_url], payload)[0]
+    if result["success"]:
+        return jsonify({"success": True, "message": f"Support notification sent to {webhook_name}"})
+    return jsonify({"success": False, "message": result["error"]})
 
 
 @app.route('/api/send-support-notification', methods=['POST'])
 def send_support_notification():
     """Send a support/donation reminder notification to all webhooks"""
-    webhooks = config.get("webhooks", [])
+    webhooks = state.config.get("webhooks", [])
     webhook_urls = [w.get("url") for w in webhooks if w.get("url")]
     
     if not webhook_urls:
@@ -815,18 +4045,9 @@ def send_support_notification():
     
     payload = get_support_payload()
     
-    success_count = 0
-    errors = []
-    
-    for url in webhook_urls:
-        try:
-            response = requests.post(url, json=payload, timeout=10)
-            if response.status_code in [200, 204]:
-                success_count += 1
-            else:
-                errors.append(f"Webhook returned {response.status_code}")
-        except Exception as e:
-            errors.append(str(e))
+    results = deliver_to_webhooks(webhook_urls, payload)
+    success_count = sum(1 for result in results if result["success"])
+    errors = [result["error"] for result in results if not result["success"]]
     
     if success_count > 0:
         msg = f"Support notification sent to {success_count} webhook(s)"
@@ -840,27 +4061,32 @@ def send_support_notification():
 @app.route('/api/clear-codes', methods=['POST'])
 def clear_codes():
     """Clear sent codes history"""
-    global sent_codes, code_expiration_data
-    
     data = request.json
     game = data.get("game")
     
-    if game and game in sent_codes:
-        sent_codes[game] = []
-        code_expiration_data[game] = {}
-    else:
-        sent_codes = {"genshin": [], "starrail": [], "zenless": []}
-        code_expiration_data = {"genshin": {}, "starrail": {}, "zenless": {}}
+    with state.lock:
+        if game and game in state.sent_codes:
+            state.clear_codes(game)
+            code_store.clear(game)
+            clear_archive(game)
+        else:
+            state.clear_codes()
+            code_store.clear()
+            clear_archive()
+    
+    # Cleared codes count as new again, so the next check must diff the full payload
+    fetch_validators.clear()
     
-    save_sent_codes()
     return jsonify({"success": True, "message": "Codes cleared"})
 
 
 # Initialize on module load (for gunicorn)
 print("Starting HoYoLab Code Notifier...")
 load_config()
+code_store = create_code_store()
 load_sent_codes()
-start_checker()
+load_delivery_queue()
+start_coordinator()
 
 if __name__ == '__main__':
     # Run Flask development server (only when running directly)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for sent-code deduplication
+Compares the old list membership scan with the set-backed index as history grows
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+# Keep the app's data files out of the real data directory
+DATA_DIR = tempfile.mkdtemp(prefix="hoyolab-bench-")
+os.environ.setdefault("CONFIG_PATH", os.path.join(DATA_DIR, "config.json"))
+os.environ.setdefault("CODES_PATH", os.path.join(DATA_DIR, "sent_codes.json"))
+os.environ.setdefault("RUN_CHECKER", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+SIZES = [1_000, 10_000, 100_000, 200_000]
+LOOKUPS = 1_000
+
+
+def bench(size):
+    """Time LOOKUPS lookups of unseen codes, the worst case for a list scan"""
+    app.state.load_codes({"genshin": [f"CODE{i:08d}" for i in range(size)]}, {})
+    probes = [f"MISS{i:08d}" for i in range(LOOKUPS)]
+    game_sent = app.state.sent_codes["genshin"]
+    
+    list_time = timeit.timeit(lambda: [p in game_sent for p in probes], number=1)
+    index_time = timeit.timeit(lambda: [app.state.is_code_sent("genshin", p) for p in probes], number=5) / 5
+    return list_time, index_time
+
+
+def main():
+    print(f"{'history':>10} {'list (us/lookup)':>18} {'index (us/lookup)':>18}")
+    for size in SIZES:
+        list_time, index_time = bench(size)
+        print(f"{size:>10} {list_time / LOOKUPS * 1e6:>18.3f} {index_time / LOOKUPS * 1e6:>18.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+End-to-end pipeline benchmark against local stand-ins
+Runs check_and_notify, send_code_notifications and /api/status against a fake ennead codes API
+and a fake Discord webhook server, for a grid of webhook counts and history sizes, and writes
+the results as JSON so runs can be compared over time
+
+    python benchmarks/bench_pipeline.py --webhooks 1,10,50 --history 0,10000 --codes 20
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Keep the app's data files out of the real data directory, and the checker out of the way
+DATA_DIR = tempfile.mkdtemp(prefix="hoyolab-bench-")
+os.environ.setdefault("CONFIG_PATH", os.path.join(DATA_DIR, "config.json"))
+os.environ.setdefault("CODES_PATH", os.path.join(DATA_DIR, "sent_codes.json"))
+os.environ.setdefault("RUN_CHECKER", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+
+
+class FakeUpstream(BaseHTTPRequestHandler):
+    """api.ennead.cc stand-in: /<game>/codes returns the configured codes after a delay"""
+    protocol_version = "HTTP/1.1"
+    codes = {}
+    latency = 0.05
+    padding = 0  # Extra bytes per code entry, to simulate larger payloads
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        game = self.path.strip("/").split("/")[0]
+        time.sleep(FakeUpstream.latency)
+        active = [{**entry, "description": "x" * FakeUpstream.padding} for entry in FakeUpstream.codes.get(game, [])]
+        body = json.dumps({"active": active, "inactive": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeDiscord(BaseHTTPRequestHandler):
+    """Discord webhook stand-in with per-webhook rate limit headers and an optional share of random 429s"""
+    protocol_version = "HTTP/1.1"
+    latency = 0.02
+    limit = 5  # Requests per window per webhook, announced in X-RateLimit-* headers
+    window = 2.0
+    random_429 = 0.0  # Share of requests answered with a 429 regardless of the bucket
+    buckets = {}
+    lock = threading.Lock()
+    received = 0
+    rejected = 0
+    delivered = 0  # (code, webhook) pairs in accepted messages
+    code_pattern = re.compile(rb"NEW[A-Z]{2}\d{10}")  # Codes generated by run_scenario
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        payload = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(FakeDiscord.latency)
+        now = time.time()
+        with FakeDiscord.lock:
+            bucket = FakeDiscord.buckets.get(self.path)
+            if not bucket or now >= bucket["reset"]:
+                bucket = FakeDiscord.buckets[self.path] = {"reset": now + FakeDiscord.window, "remaining": FakeDiscord.limit}
+            limited = bucket["remaining"] <= 0 or random.random() < FakeDiscord.random_429
+            if limited:
+                FakeDiscord.rejected += 1
+            else:
+                bucket["remaining"] -= 1
+                FakeDiscord.received += 1
+                FakeDiscord.delivered += len(set(FakeDiscord.code_pattern.findall(payload)))
+
+        body = json.dumps({"message": "You are being rate limited.", "retry_after": bucket["reset"] - now,
+                           "global": False}).encode() if limited else b""
+        self.send_response(429 if limited else 204)
+        self.send_header("X-RateLimit-Bucket", self.path)
+        self.send_header("X-RateLimit-Limit", str(FakeDiscord.limit))
+        self.send_header("X-RateLimit-Remaining", str(max(0, bucket["remaining"])))
+        self.send_header("X-RateLimit-Reset-After", f"{max(0.0, bucket['reset'] - now):.3f}")
+        if limited:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_CONNECT(self):
+        # Used as the HTTPS proxy, so requests to external hosts fail fast instead of leaving the machine
+        self.send_response(403)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else None
+
+
+def histogram_mean(app, name):
+    """Mean of an app histogram across all its labels, or None if it has no observations"""
+    values = app.metrics.metrics[name]["values"].values()
+    count = sum(value["count"] for value in values)
+    return sum(value["sum"] for value in values) / count if count else None
+
+
+def reset_app(app, webhooks, history, upstream_url, discord_url, engine):
+    """Fresh config, history and metrics for a scenario"""
+    with app.state.lock:
+        app.state.clear_codes()
+        app.code_store.clear()
+        app.clear_archive()
+    app.fetch_validators.clear()
+    app.webhook_rate_limiter.__init__()
+    for metric in app.metrics.metrics.values():
+        metric["values"].clear()
+    with app.delivery_queue_lock:
+        app.delivery_queue["pending"] = []
+        app.delivery_queue["dead_letter"] = []
+        app.delivery_queue["payloads"] = {}
+        app.save_delivery_queue()
+
+    def apply(config):
+        config["webhooks"] = [{
+            "name": f"bench-{i}",
+            "url": f"{discord_url}/api/webhooks/{i}/token",
+            "games": {game_key: True for game_key in app.GAMES_DATA}
+        } for i in range(webhooks)]
+        config["sources"] = [{"name": "ennead", "url": f"{upstream_url}/{{game}}/codes"}]
+        config["pipeline_engine"] = engine
+        config["batch_window"] = 0
+        config["delivery_max_attempts"] = 1000  # Keep the queue from dead-lettering under heavy 429s
+        config["stats_endpoint"] = ""  # Statistics reporting is not part of the measured pipeline
+    app.state.update_config(apply)
+
+    # History: codes sent long ago, half of them with an expiration
+    expires = (datetime.now(timezone.utc) + timedelta(days=7)).isoformat()
+    codes = {game_key: [f"OLD{game_key[:2].upper()}{i:07d}" for i in range(history)] for game_key in app.GAMES_DATA}
+    expiration = {game_key: {code: expires for code in game_codes[::2]} for game_key, game_codes in codes.items()}
+    app.state.load_codes(codes, expiration)
+    app.invalidate_status_cache(timezone_changed=True)
+
+
+def run_scenario(app, client, args, webhooks, history, upstream_url, discord_url):
+    reset_app(app, webhooks, history, upstream_url, discord_url, args.engine)
+    run_id = f"{webhooks}-{history}-{time.monotonic_ns()}"
+    FakeUpstream.codes = {
+        game_key: [{"code": f"NEW{game_key[:2].upper()}{i:04d}{run_id[-6:]}", "rewards": ["Primogem x60"]}
+                   for i in range(args.codes)]
+        for game_key in app.GAMES_DATA
+    }
+    FakeDiscord.buckets.clear()
+    FakeDiscord.received = FakeDiscord.rejected = FakeDiscord.delivered = 0
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    app.check_and_notify()
+    check_seconds = time.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    new_codes = args.codes * len(app.GAMES_DATA)
+    # Only (code, webhook) pairs Discord accepted during the check, not ones still queued for a retry
+    deliveries = FakeDiscord.delivered
+
+    # Status latency: rebuilt responses (cache invalidated first) and cached ones
+    cold, warm = [], []
+    for _ in range(args.status_requests):
+        app.invalidate_status_cache()
+        start = time.perf_counter()
+        client.get("/api/status")
+        cold.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        client.get("/api/status")
+        warm.append(time.perf_counter() - start)
+
+    return {
+        "webhooks": webhooks,
+        "history_per_game": history,
+        "new_codes": new_codes,
+        "check_seconds": round(check_seconds, 4),
+        "codes_per_second": round(new_codes / check_seconds, 2),
+        "deliveries_per_second": round(deliveries / check_seconds, 2),
+        "codes_delivered": deliveries,
+        "codes_expected": new_codes * webhooks,
+        "messages_sent": FakeDiscord.received,
+        "discord_429s": FakeDiscord.rejected,
+        "first_seen_to_delivered_mean": histogram_mean(app, "hoyolab_code_delivery_latency_seconds"),
+        "notification_seconds_mean": histogram_mean(app, "hoyolab_notification_duration_seconds"),
+        "fetch_seconds_mean": histogram_mean(app, "hoyolab_fetch_duration_seconds"),
+        "delivery_seconds_mean": histogram_mean(app, "hoyolab_webhook_delivery_duration_seconds"),
+        "peak_traced_memory_bytes": peak_bytes,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "status_rebuild_p50": statistics.median(cold),
+        "status_rebuild_p95": percentile(cold, 0.95),
+        "status_cached_p50": statistics.median(warm),
+        "status_cached_p95": percentile(warm, 0.95),
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_sizes(text):
+    return [int(value) for value in text.split(",") if value.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--webhooks", type=parse_sizes, default=[1, 10, 50], help="Webhook counts, comma separated")
+    parser.add_argument("--history", type=parse_sizes, default=[0, 1000, 10000], help="Sent codes per game already in history")
+    parser.add_argument("--codes", type=int, default=10, help="New codes per game in each scenario")
+    parser.add_argument("--upstream-latency", type=float, default=0.05, help="Fake codes API response delay (s)")
+    parser.add_argument("--payload-padding", type=int, default=0, help="Extra bytes per code in the codes API payload")
+    parser.add_argument("--discord-latency", type=float, default=0.02, help="Fake Discord response delay (s)")
+    parser.add_argument("--discord-limit", type=int, default=5, help="Fake Discord requests per window per webhook")
+    parser.add_argument("--discord-window", type=float, default=2.0, help="Fake Discord rate limit window (s)")
+    parser.add_argument("--discord-429", type=float, default=0.0, help="Share of requests answered 429 at random")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--status-requests", type=int, default=20, help="/api/status requests per scenario")
+    parser.add_argument("--output", help="Results file (default benchmarks/results/pipeline-<time>.json)")
+    args = parser.parse_args()
+
+    FakeUpstream.latency = args.upstream_latency
+    FakeUpstream.padding = args.payload_padding
+    FakeDiscord.latency = args.discord_latency
+    FakeDiscord.limit = args.discord_limit
+    FakeDiscord.window = args.discord_window
+    FakeDiscord.random_429 = args.discord_429
+    upstream = start_server(FakeUpstream)
+    discord = start_server(FakeDiscord)
+    upstream_url = f"http://127.0.0.1:{upstream.server_port}"
+    discord_url = f"http://127.0.0.1:{discord.server_port}"
+
+    # Stray outbound requests to external hosts go to the fake server and fail fast
+    os.environ["HTTPS_PROXY"] = discord_url
+    os.environ["NO_PROXY"] = "127.0.0.1,localhost"
+
+    import app
+    client = app.app.test_client()
+
+    results = []
+    print(f"{'webhooks':>8} {'history':>8} {'codes/s':>9} {'deliv/s':>9} {'seen->sent':>11} "
+          f"{'429s':>6} {'peak MB':>8} {'status ms':>10}")
+    for webhooks in args.webhooks:
+        for history in args.history:
+            result = run_scenario(app, client, args, webhooks, history, upstream_url, discord_url)
+            results.append(result)
+            latency = result["first_seen_to_delivered_mean"]
+            print(f"{webhooks:>8} {history:>8} {result['codes_per_second']:>9.1f} "
+                  f"{result['deliveries_per_second']:>9.1f} {latency if latency is not None else float('nan'):>10.3f}s "
+                  f"{result['discord_429s']:>6} {result['peak_traced_memory_bytes'] / 1e6:>8.1f} "
+                  f"{result['status_rebuild_p50'] * 1000:>10.2f}")
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"pipeline-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "benchmark": "pipeline",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+            "results": results
+        }, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
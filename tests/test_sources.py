@@ -0,0 +1,234 @@
+"""
+Code source tests against local http.server stand-ins
+Covers the ennead/json/html adapters, normalize_codes, the first-report-wins race between sources
+and the confirmation threshold for untrusted sources
+
+    pip install pytest && python -m pytest tests
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# Keep the app's data files out of the real data directory, and the checker out of the way
+DATA_DIR = tempfile.mkdtemp(prefix="hoyolab-tests-")
+os.environ.setdefault("CONFIG_PATH", os.path.join(DATA_DIR, "config.json"))
+os.environ.setdefault("CODES_PATH", os.path.join(DATA_DIR, "sent_codes.json"))
+os.environ.setdefault("RUN_CHECKER", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class FakeSource(BaseHTTPRequestHandler):
+    """Code source stand-in: serves routes[path] = (content type, body, delay)"""
+    protocol_version = "HTTP/1.1"
+    routes = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        content_type, body, delay = FakeSource.routes.get(self.path, ("text/plain", "", 0))
+        time.sleep(delay)
+        body = body.encode()
+        self.send_response(200 if self.path in FakeSource.routes else 404)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeDiscord(BaseHTTPRequestHandler):
+    """Discord webhook stand-in that accepts every message and keeps its body"""
+    protocol_version = "HTTP/1.1"
+    received = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        FakeDiscord.received.append(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture(scope="module")
+def source_url():
+    server = start_server(FakeSource)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture(scope="module")
+def discord_url():
+    server = start_server(FakeDiscord)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def serve(path, body, content_type="application/json", delay=0):
+    FakeSource.routes[path] = (content_type, body if isinstance(body, str) else json.dumps(body), delay)
+
+
+def ennead_body(*codes):
+    return {"active": [{"code": code, "rewards": ["Primogem x60"]} for code in codes], "inactive": []}
+
+
+@pytest.fixture
+def checker(source_url, discord_url):
+    """Fresh history and a single genshin webhook; returns a function that sets the sources"""
+    FakeSource.routes.clear()
+    FakeDiscord.received.clear()
+    with app.state.lock:
+        app.state.clear_codes()
+        app.code_store.clear()
+        app.clear_archive()
+    app.fetch_validators.clear()
+    app.code_sightings.clear()
+    app.code_first_seen.clear()
+    with app.source_stats_lock:
+        app.source_stats.clear()
+    with app.delivery_queue_lock:
+        app.delivery_queue["pending"] = []
+        app.delivery_queue["dead_letter"] = []
+        app.save_delivery_queue()
+
+    def set_sources(sources, min_confirmations=2):
+        def apply(config):
+            config["webhooks"] = [{"name": "test", "url": f"{discord_url}/api/webhooks/1/token", "games": {"genshin": True}}]
+            # The built-in API is replaced by the test sources
+            config["sources"] = [{"name": "ennead", "enabled": False}] + [
+                {**source, "url": source_url + source["url"]} for source in sources
+            ]
+            config["source_min_confirmations"] = min_confirmations
+            config["batch_window"] = 0
+            config["stats_endpoint"] = ""
+        app.state.update_config(apply)
+
+    return set_sources
+
+
+def test_normalize_codes():
+    codes = app.normalize_codes({"name": "test"}, [
+        {"code": " genshingift ", "rewards": ["Primogem x60"]},
+        {"code": "GENSHINGIFT", "rewards": ["duplicate"]},
+        {"code": ""},
+        {"code": None},
+        {"rewards": ["no code"]},
+        {"code": "Other1"},
+    ])
+    assert codes == [
+        {"code": "GENSHINGIFT", "rewards": ["Primogem x60"], "source": "test"},
+        {"code": "OTHER1", "source": "test"},
+    ]
+
+
+def test_ennead_adapter(checker, source_url):
+    serve("/genshin/codes", ennead_body("genshingift", "GENSHINGIFT", "SPRING2024"))
+    codes, validators = app.fetch_codes("genshin", {"name": "ennead", "type": "ennead", "url": f"{source_url}/genshin/codes"})
+    assert [code_data["code"] for code_data in codes] == ["GENSHINGIFT", "SPRING2024"]
+    assert codes[0]["rewards"] == ["Primogem x60"]
+    assert {code_data["source"] for code_data in codes} == {"ennead"}
+    assert validators["hash"]
+
+
+def test_json_adapter(checker, source_url):
+    serve("/feed", {"data": {"items": ["plaincode", {"key": "objcode", "reward": "Mora"}, {"key": ""}, 5]}})
+    source = {"name": "feed", "type": "json", "url": f"{source_url}/feed", "path": "data.items", "code_field": "key"}
+    codes, _ = app.fetch_codes("genshin", source)
+    assert [code_data["code"] for code_data in codes] == ["PLAINCODE", "OBJCODE"]
+    assert codes[1]["reward"] == "Mora"
+
+    # A path that does not lead to a list is an error, not an empty result
+    serve("/feed", {"data": {"items": {"code": "X"}}})
+    assert app.fetch_codes("genshin", source) == (app.FETCH_FAILED, None)
+    assert app.source_stats["feed"]["failures"] == 1
+
+
+def test_html_adapter(checker, source_url):
+    serve("/post", '<a href="https://genshin.hoyoverse.com/en/gift?code=LINKCODE1">redeem</a>'
+                   '<a href="https://genshin.hoyoverse.com/en/gift?lang=en&code=linkcode2">again</a>'
+                   '<p>Code: TEXTCODE3</p>', content_type="text/html")
+    codes, _ = app.fetch_codes("genshin", {"name": "post", "type": "html", "url": f"{source_url}/post"})
+    assert [code_data["code"] for code_data in codes] == ["LINKCODE1", "LINKCODE2"]
+
+    codes, _ = app.fetch_codes("genshin", {"name": "post", "type": "html", "url": f"{source_url}/post",
+                                           "pattern": r"Code: ([A-Z0-9]+)"})
+    assert [code_data["code"] for code_data in codes] == ["TEXTCODE3"]
+
+
+def test_first_report_wins(checker):
+    serve("/fast", ennead_body("RACECODE"))
+    serve("/slow", ennead_body("RACECODE"), delay=0.5)
+    checker([
+        {"name": "slow", "type": "ennead", "url": "/slow"},
+        {"name": "fast", "type": "ennead", "url": "/fast"},
+    ])
+
+    app.check_and_notify()
+
+    assert app.state.is_code_sent("genshin", "RACECODE")
+    assert len(FakeDiscord.received) == 1
+    assert app.source_stats["fast"]["first_reports"] == 1
+    assert app.source_stats["slow"]["first_reports"] == 0
+
+    # The slow source's report is a duplicate on the next check as well
+    app.check_and_notify()
+    assert len(FakeDiscord.received) == 1
+
+
+def test_untrusted_source_needs_confirmation(checker):
+    serve("/rumors", ennead_body("RUMORCODE"))
+    serve("/forum", ennead_body("RUMORCODE"))
+    rumors = {"name": "rumors", "type": "ennead", "url": "/rumors", "trusted": False}
+    forum = {"name": "forum", "type": "ennead", "url": "/forum", "trusted": False}
+
+    # A single untrusted report is held back
+    checker([rumors])
+    app.check_and_notify()
+    assert not app.state.is_code_sent("genshin", "RUMORCODE")
+    assert app.code_sightings[("genshin", "RUMORCODE")] == {"rumors"}
+    assert FakeDiscord.received == []
+
+    # A second source reporting it, in a later check, confirms it
+    checker([rumors, forum])
+    app.check_and_notify()
+    assert app.state.is_code_sent("genshin", "RUMORCODE")
+    assert ("genshin", "RUMORCODE") not in app.code_sightings
+    assert len(FakeDiscord.received) == 1
+    assert "RUMORCODE" in FakeDiscord.received[0]
+
+
+def test_untrusted_threshold_is_configurable(checker):
+    serve("/rumors", ennead_body("RUMORCODE"))
+    checker([{"name": "rumors", "type": "ennead", "url": "/rumors", "trusted": False}], min_confirmations=1)
+
+    app.check_and_notify()
+
+    assert app.state.is_code_sent("genshin", "RUMORCODE")
+    assert len(FakeDiscord.received) == 1
+
+
+def test_failed_fetch_keeps_backoff(checker):
+    checker([{"name": "down", "type": "ennead", "url": "/missing"}])
+    app.game_schedule["genshin"] = {"quiet_interval": 900, "last_new_code": 0}
+
+    app.check_and_notify(["genshin"])
+
+    # A source that errors says nothing about the game: neither reset to check_interval nor backed off further
+    assert app.game_schedule["genshin"]["quiet_interval"] == 900
+    assert app.source_stats["down"]["failures"] == 1